@@ -0,0 +1,349 @@
+#! /usr/bin/env python3
+#
+# Copyright (C) 2018 Undo Ltd.
+
+'''
+Benchmark apply-format and the pre-commit hook on big synthetic diffs.
+
+The built-in code used to find and format changed lines is compared with
+clang-format-diff, making sure both produce the same output.
+
+The results can be saved as JSON (with --output) and compared with the ones
+saved by a previous run (with --baseline), so a change which makes things
+slower can be detected.
+'''
+
+import argparse
+import collections
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from mixin_git import (
+    GitMixin,
+    GitRepository,
+    )
+
+
+FORMATTED_FUNCTION = '''\
+int function_{idx}(int a) {{
+  if (a) {{
+    return a + {idx};
+  }}
+  return {idx};
+}}
+'''
+
+UNFORMATTED_FUNCTION = '''\
+int function_{idx}(int a) {{
+  if (a) {{
+  return a + {idx};
+  }}
+  return {idx};
+}}
+'''
+
+# The directory containing the files which are excluded from formatting.
+EXCLUDED_DIR = 'third_party'
+
+# The shape of the generated repository.
+RepoConfig = collections.namedtuple(
+    'RepoConfig', ['files', 'functions', 'hunks', 'excluded_files', 'exclude_patterns'])
+
+
+def file_content(functions, hunks):
+    '''
+    Generate the content of a C file.
+
+    functions:
+        The number of functions in the file.
+    hunks:
+        The number of badly formatted functions, spread in the file so each one
+        ends up in a separate hunk.
+        If 0, all the functions are correctly formatted.
+    Return value:
+        The content of the file as a string.
+    '''
+    step = max(functions // hunks, 1) if hunks else 0
+    content = []
+    for idx in range(functions):
+        if step and not idx % step and idx // step < hunks:
+            template = UNFORMATTED_FUNCTION
+        else:
+            template = FORMATTED_FUNCTION
+        content.append(template.format(idx=idx))
+    return '\n'.join(content)
+
+
+def generate_repo(repo_dir, repo_config):
+    '''
+    Create a git repository with `repo_config.files` committed C files, each
+    of which has `repo_config.hunks` unstaged badly formatted changes.
+
+    `repo_config.excluded_files` more files with the same changes are created
+    in `EXCLUDED_DIR`, and `repo_config.exclude_patterns` are written to the
+    .clang-format-hook-exclude file.
+
+    Return value:
+        The GitRepository instance.
+    '''
+    subprocess.check_output(['git', 'init', repo_dir], stderr=subprocess.STDOUT)
+    repo = GitRepository(repo_dir)
+    files, functions, hunks, excluded_files, exclude_patterns = repo_config
+
+    paths = ['file{:05}.c'.format(idx) for idx in range(files)]
+    if excluded_files:
+        os.makedirs(repo.abs_path_in_repo(EXCLUDED_DIR))
+        paths += [os.path.join(EXCLUDED_DIR, 'file{:05}.c'.format(idx))
+                  for idx in range(excluded_files)]
+    for path in paths:
+        repo.write_file(path, file_content(functions, 0))
+    if exclude_patterns:
+        repo.write_file('.clang-format-hook-exclude', '\n'.join(exclude_patterns) + '\n')
+        paths.append('.clang-format-hook-exclude')
+    repo.git_check_call('add', *paths)
+    repo.commit()
+
+    for path in paths:
+        if path.endswith('.c'):
+            repo.write_file(path, file_content(functions, hunks))
+
+    return repo
+
+
+def time_command(repo, args, repeat, expected_status=0):
+    '''
+    Run a command `repeat` times in the repository.
+
+    expected_status:
+        The exit status the command must have.
+    Return value:
+        A tuple with the minimum time in seconds and the output.
+    '''
+    best = None
+    output = None
+    for _ in range(repeat):
+        start = time.monotonic()
+        proc = subprocess.run(args,
+                              cwd=repo.repo_dir,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT,
+                              universal_newlines=True,
+                              check=False)
+        elapsed = time.monotonic() - start
+        if proc.returncode != expected_status:
+            raise subprocess.CalledProcessError(proc.returncode, args, proc.stdout)
+        output = proc.stdout
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, output
+
+
+def count_processes(repo, args, repeat, expected_status=0):
+    '''
+    Run a command `repeat` times in the repository, counting the processes it
+    starts (including itself).
+
+    The count is based on the number of processes created by the whole system
+    (from /proc/stat), so the minimum among the runs is used to ignore what
+    other programs are doing.
+
+    expected_status:
+        The exit status the command must have.
+    Return value:
+        The minimum number of processes, or None if they cannot be counted (for
+        instance, because /proc/stat is not available).
+    '''
+    def created_processes():
+        try:
+            with open('/proc/stat') as stat_file:
+                for line in stat_file:
+                    if line.startswith('processes '):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        return None
+
+    best = None
+    for _ in range(repeat):
+        before = created_processes()
+        proc = subprocess.run(args,
+                              cwd=repo.repo_dir,
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL,
+                              check=False)
+        after = created_processes()
+        if proc.returncode != expected_status:
+            raise subprocess.CalledProcessError(proc.returncode, args)
+        if before is None or after is None:
+            return None
+        if best is None or after - before < best:
+            best = after - before
+    return best
+
+
+def time_apply_format(repo, args, repeat):
+    '''
+    Run apply-format `repeat` times with the specified arguments.
+
+    Return value:
+        A tuple with the minimum time in seconds and the output.
+    '''
+    apply_format = os.path.join(GitMixin.this_repo_path(), 'apply-format')
+    return time_command(repo, [apply_format] + list(args), repeat)
+
+
+def run_benchmarks(repo, repeat):
+    '''
+    Time apply-format on the unstaged changes, on the staged ones and on whole
+    files, and the pre-commit hook.
+
+    The built-in code is compared with clang-format-diff, both on unstaged and
+    on staged changes.
+
+    Return value:
+        A tuple with a dictionary mapping the name of each benchmark to the time
+        in seconds (or, for "hook-processes", to the number of processes started
+        by the pre-commit hook) and a boolean which is False if the outputs of the built-in
+        code and of clang-format-diff were different.
+    '''
+    results = {}
+    success = True
+
+    paths = repo.git_check_output('ls-files', '*.c').split()
+    results['whole-file'], _ = time_apply_format(repo, ['-f'] + paths, repeat)
+
+    for label, args in (('unstaged', []), ('staged', ['--staged'])):
+        if args:
+            repo.git_check_call('add', '--update')
+
+        builtin_time, builtin_output = time_apply_format(repo, args, repeat)
+        diff_time, diff_output = time_apply_format(repo, ['--clang-format-diff'] + args, repeat)
+        results[label] = builtin_time
+        results[label + '-clang-format-diff'] = diff_time
+
+        print('{:10} built-in: {:7.3f}s   clang-format-diff: {:7.3f}s   speed-up: {:.2f}x'.format(
+            label, builtin_time, diff_time, diff_time / builtin_time))
+
+        if builtin_output != diff_output:
+            print('  The outputs are different!')
+            success = False
+
+    # The hook rejects the commit as the staged content is not formatted
+    # correctly. The cache is disabled, so the content is reformatted every
+    # time.
+    hook = os.path.join(GitMixin.this_repo_path(), 'git-pre-commit-format')
+    repo.check_output(hook, 'install')
+    repo.git_check_call('config', 'hooks.clangFormatDiffInteractive', 'false')
+    repo.git_check_call('config', 'hooks.clangFormatDiffCache', 'false')
+    hook_args = ['git', 'commit', '-m', 'benchmark']
+    results['hook'], _ = time_command(repo, hook_args, repeat, expected_status=1)
+    # The number of processes (including git itself) is more stable than the
+    # time, so it shows better the cost of the work done by the hook before
+    # formatting anything.
+    processes = count_processes(repo, hook_args, repeat, expected_status=1)
+
+    print('{:10} {:7.3f}s'.format('whole-file', results['whole-file']))
+    print('{:10} {:7.3f}s'.format('hook', results['hook']))
+    if processes is not None:
+        results['hook-processes'] = processes
+        print('{:10} {} processes'.format('hook', processes))
+
+    return results, success
+
+
+def compare_with_baseline(results, config, baseline_path, tolerance):
+    '''
+    Compare the results with the ones stored in a baseline file.
+
+    tolerance:
+        How much slower (as a fraction, for instance 0.2 for 20%) each
+        benchmark can be compared to the baseline.
+    Return value:
+        True if no benchmark was too slow, False otherwise.
+    '''
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+
+    if baseline['config'] != config:
+        print('The baseline was generated with a different configuration: {}'.format(
+            baseline['config']))
+        return False
+
+    success = True
+    for name, elapsed in sorted(results.items()):
+        base_elapsed = baseline['results'].get(name)
+        if base_elapsed is None:
+            continue
+        limit = base_elapsed * (1 + tolerance)
+        if elapsed > limit:
+            print('{} is too slow: {:.3f} (baseline: {:.3f}, limit: {:.3f})'.format(
+                name, elapsed, base_elapsed, limit))
+            success = False
+
+    return success
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=200,
+                        help='number of changed files')
+    parser.add_argument('--functions', type=int, default=50,
+                        help='number of functions in each file')
+    parser.add_argument('--hunks', type=int, default=10,
+                        help='number of changed hunks in each file')
+    parser.add_argument('--excluded-files', type=int, default=0,
+                        help='number of changed files in the {} directory'.format(EXCLUDED_DIR))
+    parser.add_argument('--exclude', action='append', dest='exclude_patterns', default=[],
+                        metavar='PATTERN',
+                        help='pattern to add to .clang-format-hook-exclude (can be repeated)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of times to run each command (the fastest run is used)')
+    parser.add_argument('--output', metavar='FILE',
+                        help='save the results as JSON to FILE')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='fail if the results are slower than the ones saved in FILE')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='how much slower than the baseline the results can be '
+                        '(default: 0.2, that is 20%%)')
+    args = parser.parse_args(argv[1:])
+
+    config = {
+        'files': args.files,
+        'functions': args.functions,
+        'hunks': args.hunks,
+        'excluded-files': args.excluded_files,
+        'exclude': args.exclude_patterns,
+        }
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        repo_config = RepoConfig(args.files, args.functions, args.hunks, args.excluded_files,
+                                 args.exclude_patterns)
+        repo = generate_repo(os.path.join(tmp_dir, 'repo'), repo_config)
+        print('{} files ({} excluded), {} functions per file, {} hunks per file'.format(
+            args.files + args.excluded_files, args.excluded_files, args.functions, args.hunks))
+        results, success = run_benchmarks(repo, args.repeat)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({'config': config, 'results': results}, output_file, indent=4,
+                      sort_keys=True)
+            output_file.write('\n')
+
+    if args.baseline and not compare_with_baseline(results, config, args.baseline,
+                                                   args.tolerance):
+        success = False
+
+    return success
+
+
+if __name__ == '__main__':
+    if not main(sys.argv):
+        raise SystemExit(1)
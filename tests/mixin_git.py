@@ -1,8 +1,10 @@
 # Copyright (C) 2018 Marco Barisione
 # Copyright (C) 2018 Undo Ltd.
 
+import atexit
 import os
 import re
+import shutil
 import subprocess
 import tempfile
 
@@ -10,6 +12,74 @@ import mixin_tempdir
 import testutils
 
 
+# The snapshots taken by `GitMixin.repo_from_snapshot`, shared by all the tests run by this
+# process.
+# Each key maps to a tuple containing the directory with the snapshot, the path of the
+# temporary directory which was copied, the path of the repository relative to it and the
+# extra value returned by the function which created the repository.
+_SNAPSHOTS = {}
+_SNAPSHOTS_DIR = None
+
+
+def _snapshots_dir():
+    global _SNAPSHOTS_DIR # pylint: disable=global-statement
+    if _SNAPSHOTS_DIR is None:
+        _SNAPSHOTS_DIR = tempfile.mkdtemp()
+        atexit.register(shutil.rmtree, _SNAPSHOTS_DIR, True)
+    return _SNAPSHOTS_DIR
+
+
+def _copy_file(src, dst):
+    '''
+    Copy a file, using a hard link for git objects as they are never modified.
+    '''
+    if os.sep + 'objects' + os.sep in src:
+        try:
+            os.link(src, dst)
+            return dst
+        except OSError:
+            pass
+    return shutil.copy2(src, dst)
+
+
+def _copy_dir_content(src_dir, dst_dir):
+    '''
+    Copy everything inside `src_dir` to the existing `dst_dir`.
+
+    Absolute paths pointing inside `src_dir` which git stored (for instance, for worktrees)
+    are changed to point inside `dst_dir`.
+    '''
+    for name in os.listdir(src_dir):
+        src = os.path.join(src_dir, name)
+        dst = os.path.join(dst_dir, name)
+        if os.path.isdir(src) and not os.path.islink(src):
+            shutil.copytree(src, dst, symlinks=True, copy_function=_copy_file)
+        else:
+            _copy_file(src, dst)
+
+    replacements = [
+        (os.path.realpath(src_dir), os.path.realpath(dst_dir)),
+        (src_dir, dst_dir),
+        ]
+    for dir_path, dir_names, file_names in os.walk(dst_dir):
+        if 'objects' in dir_names:
+            dir_names.remove('objects')
+        for file_name in file_names:
+            if file_name not in ('.git', 'gitdir', 'config'):
+                continue
+            path = os.path.join(dir_path, file_name)
+            if os.path.islink(path):
+                continue
+            with open(path) as git_file:
+                content = git_file.read()
+            new_content = content
+            for old, new in replacements:
+                new_content = new_content.replace(old, new)
+            if new_content != content:
+                with open(path, 'w') as git_file:
+                    git_file.write(new_content)
+
+
 class GitRepository:
     '''
     A class representing a git repository.
@@ -23,6 +93,8 @@ class GitRepository:
             The path to the directory where an initialized git repository is.
         '''
         self.repo_dir = repo_dir
+        # Environment variables to overwrite for all the commands run in the repository.
+        self.env = {}
 
     @property
     def git_dir(self):
@@ -32,49 +104,75 @@ class GitRepository:
         NOTE: This is broken for submodules as we don't really need support for
         that at the moment!
         '''
-        with self.work_dir():
-            # Simple, this is a normal .git repo with a .git directory.
-            if os.path.isdir('.git'):
-                return os.path.abspath('.git')
-
-            # A worktree or a submodule! Damn!
-            with open('.git') as git_file:
-                content = git_file.read().rstrip()
-            intro = 'gitdir: '
-            assert content.startswith(intro), \
-                'Unexpected content of .git file: {}'.format(content)
-            worktree_git_dir = content[len(intro):]
-
-            # Now we have the git directory for this worktree's branch, it should
-            # be something like PROJECT/.git/worktrees/WORKTREE-DIR-NAME.
-            # We just rely on the path structure to extract the main dir, this is
-            # good enough for tests.
-            # Note that we ignore submodules for now as we don't really need to
-            # support them.
-            worktree_git_dir = os.path.normpath(worktree_git_dir)
-            components = worktree_git_dir.split(os.path.sep)
-            assert components[-2] == 'worktrees'
-            # Everything before the worktrees directory.
-            return os.path.sep.join(components[:-2])
-
-    def work_dir(self):
-        return testutils.WorkDir(self.repo_dir)
-
-    def check_call(self, *args):
-        with self.work_dir():
-            return subprocess.check_call(args, stderr=subprocess.STDOUT)
+        dot_git = self.abs_path_in_repo('.git')
+
+        # Simple, this is a normal .git repo with a .git directory.
+        if os.path.isdir(dot_git):
+            return os.path.abspath(dot_git)
+
+        # A worktree or a submodule! Damn!
+        with open(dot_git) as git_file:
+            content = git_file.read().rstrip()
+        intro = 'gitdir: '
+        assert content.startswith(intro), \
+            'Unexpected content of .git file: {}'.format(content)
+        worktree_git_dir = content[len(intro):]
+
+        # Now we have the git directory for this worktree's branch, it should
+        # be something like PROJECT/.git/worktrees/WORKTREE-DIR-NAME.
+        # We just rely on the path structure to extract the main dir, this is
+        # good enough for tests.
+        # Note that we ignore submodules for now as we don't really need to
+        # support them.
+        worktree_git_dir = os.path.normpath(os.path.join(self.repo_dir, worktree_git_dir))
+        components = worktree_git_dir.split(os.path.sep)
+        assert components[-2] == 'worktrees'
+        # Everything before the worktrees directory.
+        return os.path.sep.join(components[:-2])
+
+    def _subprocess_kwargs(self, kwargs):
+        '''
+        Update the keyword arguments for a `subprocess` function so the command runs
+        in the repository.
 
-    def check_output(self, *args, **kwargs):
+        The current directory and the environment of this process are never changed, so
+        tests can run in parallel.
+
+        kwargs:
+            The keyword arguments. `cwd` is a path relative to the repository top level
+            dir (by default, the top level dir itself), while `env` is a dictionary of
+            environment variables to overwrite (in addition to the ones in `self.env`).
+        Return value:
+            `kwargs`.
+        '''
+        overwrite_env = dict(self.env)
+        overwrite_env.update(kwargs.get('env') or {})
+        kwargs['cwd'] = self.abs_path_in_repo(kwargs.get('cwd') or '.')
+        kwargs['env'] = testutils.make_env(overwrite_env)
         kwargs['stderr'] = subprocess.STDOUT
+        return kwargs
+
+    def check_call(self, *args, **kwargs):
+        return subprocess.check_call(args, **self._subprocess_kwargs(kwargs))
+
+    def check_output(self, *args, **kwargs):
         kwargs['universal_newlines'] = True
-        with self.work_dir():
-            return subprocess.check_output(args, **kwargs)
+        return subprocess.check_output(args, **self._subprocess_kwargs(kwargs))
 
-    def git_check_call(self, *args):
-        return self.check_call('git', *args)
+    def popen(self, *args, **kwargs):
+        '''
+        Start a command in the background, with its output available in the `stdout`
+        attribute of the returned `subprocess.Popen`.
+        '''
+        kwargs['universal_newlines'] = True
+        kwargs['stdout'] = subprocess.PIPE
+        return subprocess.Popen(args, **self._subprocess_kwargs(kwargs))
+
+    def git_check_call(self, *args, **kwargs):
+        return self.check_call('git', *args, **kwargs)
 
-    def git_check_output(self, *args):
-        return self.check_output('git', *args)
+    def git_check_output(self, *args, **kwargs):
+        return self.check_output('git', *args, **kwargs)
 
     def abs_path_in_repo(self, rel_path):
         return os.path.join(self.repo_dir, rel_path)
@@ -92,7 +190,7 @@ class GitRepository:
         with open(abs_path, 'r') as content_file:
             return content_file.read()
 
-    def commit(self, verify=True, input_text=None):
+    def commit(self, verify=True, input_text=None, env=None):
         args = ['-m', 'test']
         if not verify:
             args.append('--no-verify')
@@ -100,7 +198,7 @@ class GitRepository:
         tmp_path = None
 
         try:
-            overwrite_env = {}
+            overwrite_env = dict(env or {})
             if input_text is not None:
                 tmp_path = tempfile.mktemp()
                 if input_text:
@@ -108,8 +206,7 @@ class GitRepository:
                         tmp_file.write(input_text)
                 overwrite_env['PRE_COMMIT_HOOK_TTY'] = tmp_path
 
-            with testutils.EnvAdder(overwrite_env):
-                return self.git_check_output('commit', *args)
+            return self.git_check_output('commit', *args, env=overwrite_env)
 
         finally:
             if tmp_path is not None:
@@ -142,6 +239,38 @@ class GitMixin(mixin_tempdir.TempDirMixin):
 
         return repo
 
+    def repo_from_snapshot(self, key, create_repo):
+        '''
+        Get a repository in this test's temporary directory, creating it only once for each
+        `key` and copying it from a snapshot afterwards.
+
+        Creating repositories (for instance cloning them or adding submodules) is slow, so
+        the first time a `key` is used, the content of the temporary directory is saved after
+        calling `create_repo`. The next tests using the same `key` get a copy of it.
+
+        key:
+            A string identifying how the repository is created.
+        create_repo:
+            A function, called with no arguments, which creates a repository inside this
+            test's temporary directory (which should be empty) and returns a tuple
+            containing the `GitRepository` instance and any other value to save with it.
+        Return value:
+            A tuple containing the `GitRepository` instance and the extra value returned by
+            `create_repo`.
+        '''
+        snapshot = _SNAPSHOTS.get(key)
+        if snapshot is None:
+            repo, extra = create_repo()
+            snapshot_dir = tempfile.mkdtemp(dir=_snapshots_dir())
+            _copy_dir_content(self.tmp_dir, snapshot_dir)
+            rel_repo_dir = os.path.relpath(repo.repo_dir, self.tmp_dir)
+            _SNAPSHOTS[key] = (snapshot_dir, rel_repo_dir, extra)
+            return repo, extra
+
+        snapshot_dir, rel_repo_dir, extra = snapshot
+        _copy_dir_content(snapshot_dir, self.tmp_dir)
+        return GitRepository(os.path.join(self.tmp_dir, rel_repo_dir)), extra
+
     def clone_repo(self, original_repo):
         repo_dir = os.path.join(self.make_tmp_sub_dir(), 'cloned')
         subprocess.check_output(['git', 'clone', original_repo, repo_dir],
@@ -150,12 +279,12 @@ class GitMixin(mixin_tempdir.TempDirMixin):
 
     @staticmethod
     def this_repo_path():
-        with testutils.WorkDir(os.path.dirname(__file__)):
-            path = subprocess.check_output(['git', 'rev-parse', '--show-toplevel'],
-                                           universal_newlines=True).strip()
-            assert path
-            assert os.path.isdir(path)
-            return path
+        path = subprocess.check_output(['git', 'rev-parse', '--show-toplevel'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       universal_newlines=True).strip()
+        assert path
+        assert os.path.isdir(path)
+        return path
 
     @staticmethod
     def simplify_diff(diff):
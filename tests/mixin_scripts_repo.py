@@ -3,6 +3,7 @@
 
 import os
 import shutil
+import sys
 
 from mixin_git import (
     GitMixin,
@@ -18,8 +19,13 @@ class ScriptsRepoMixin(GitMixin):
     How the scripts end up in the repo is decided by derived classes.
     By using classes derived from this mixin, you can get your tests to run in various
     configuration.
+
+    The scripts use stub_clang_format.py and stub_clang_format_diff.py (which always
+    produce the same output and are fast) unless `REAL_CLANG_FORMAT` is true.
     '''
 
+    REAL_CLANG_FORMAT = False
+
     def __init__(self, *args, **kwargs):
         super(ScriptsRepoMixin, self).__init__(*args, **kwargs)
 
@@ -32,6 +38,53 @@ class ScriptsRepoMixin(GitMixin):
         assert not self.repo
         assert not self.scripts_dir
 
+        # Creating the repository is slow, so it's done only once for each configuration and
+        # the other tests get a copy.
+        self.repo, self.scripts_dir = self.repo_from_snapshot(self.snapshot_key,
+                                                              self.create_repo)
+
+        assert self.repo
+
+        self.repo.env.update(self.tools_env())
+        # The scripts cache the tools they find, and tests must not pollute (or
+        # depend on) the real cache.
+        self.repo.env['XDG_CACHE_HOME'] = self.make_tmp_sub_dir()
+
+    def tools_env(self):
+        '''
+        The environment variables telling the scripts which clang-format and
+        clang-format-diff to use.
+        '''
+        if self.REAL_CLANG_FORMAT:
+            return {}
+
+        def stub_command(name):
+            # Running the Python interpreter directly is faster than going through
+            # "/usr/bin/env python3".
+            path = os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+            return '{} {}'.format(sys.executable, path)
+
+        return {
+            'CLANG_FORMAT': stub_command('stub_clang_format.py'),
+            'CLANG_FORMAT_DIFF': stub_command('stub_clang_format_diff.py'),
+            }
+
+    @property
+    def snapshot_key(self):
+        '''
+        A string identifying how the repository used by the tests is created.
+        '''
+        cls = type(self)
+        return '{} {}'.format(cls.config_repo.__qualname__, cls.create_repo.__qualname__)
+
+    def create_repo(self):
+        '''
+        Create the repository used by the tests.
+
+        Return value:
+            A tuple containing the newly created GitRepository instance and the path of the
+            directory containing the scripts.
+        '''
         # This class's config_repo doesn't return, but the derived ones do.
         self.repo = self.config_repo() # pylint: disable=assignment-from-no-return
 
@@ -40,6 +93,8 @@ class ScriptsRepoMixin(GitMixin):
         # If case we cloned the current repo but there's unstaged content.
         self.update_scripts()
 
+        return self.repo, self.scripts_dir
+
     def update_scripts(self):
         '''
         Overwrite the scripts in the repo with the current version (including uncommitted changes).
@@ -47,11 +102,12 @@ class ScriptsRepoMixin(GitMixin):
         assert self.repo
 
         src_dir = self.this_repo_path()
-        with self.repo.work_dir():
-            if self.scripts_dir:
-                testutils.makedirs(self.scripts_dir)
-            shutil.copy(os.path.join(src_dir, 'apply-format'), self.apply_format_path)
-            shutil.copy(os.path.join(src_dir, 'git-pre-commit-format'), self.pre_commit_hook_path)
+        if self.scripts_dir:
+            testutils.makedirs(self.repo.abs_path_in_repo(self.scripts_dir))
+        shutil.copy(os.path.join(src_dir, 'apply-format'),
+                    self.repo.abs_path_in_repo(self.apply_format_path))
+        shutil.copy(os.path.join(src_dir, 'git-pre-commit-format'),
+                    self.repo.abs_path_in_repo(self.pre_commit_hook_path))
 
     def tearDown(self):
         super(ScriptsRepoMixin, self).tearDown()
@@ -99,6 +155,26 @@ class ScriptsRepoMixin(GitMixin):
         content = '\n'.join(content_list)
         self.repo.write_file('.clang-format', content)
 
+    def apply_format_call(self, *args, **kwargs):
+        assert self.repo
+        return self.repo.check_call(os.path.join('.', self.apply_format_path), *args, **kwargs)
+
+    def apply_format_output(self, *args, **kwargs):
+        assert self.repo
+        return self.repo.check_output(os.path.join('.', self.apply_format_path), *args,
+                                      **kwargs)
+
+    def cache_stats(self):
+        '''
+        The statistics printed by "apply-format --cache-stats", as a dictionary.
+        '''
+        output = self.apply_format_output('--cache-stats')
+        stats = {}
+        for line in output.splitlines():
+            key, value = line.split(': ', 1)
+            stats[key] = value
+        return stats
+
 
 class ScriptsWorkTreeRepoMixin(ScriptsRepoMixin):
     '''
@@ -109,8 +185,8 @@ class ScriptsWorkTreeRepoMixin(ScriptsRepoMixin):
     configuration.
     '''
 
-    def setUp(self):
-        super(ScriptsWorkTreeRepoMixin, self).setUp()
+    def create_repo(self):
+        super(ScriptsWorkTreeRepoMixin, self).create_repo()
 
         # Now the repo should be setup, but we create an alternative worktree dir
         # and use that one instead of the main one.
@@ -142,6 +218,8 @@ class ScriptsWorkTreeRepoMixin(ScriptsRepoMixin):
         # If case we cloned the current repo but there's unstaged content.
         self.update_scripts()
 
+        return self.repo, self.scripts_dir
+
 
 class CloneRepoMixin():
     '''
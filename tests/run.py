@@ -3,8 +3,14 @@
 # Copyright (C) 2017-2018 Marco Barisione
 # Copyright (C) 2018      Undo Ltd.
 
+import collections
+import io
+import multiprocessing
 import os
+import shutil
 import sys
+import tempfile
+import time
 import unittest
 
 
@@ -12,10 +18,152 @@ import unittest
 # require a full image build/run/etc.
 ALL_TESTS = [
     'test_apply_format',
+    'test_apply_format_modes',
     'test_hook',
     ]
 
 
+def extract_jobs(argv):
+    '''
+    Remove the `-j`/`--jobs` option from the command line arguments.
+
+    argv:
+        The command line arguments, which are modified in place.
+    Return value:
+        The number of processes to use to run the tests.
+    '''
+    jobs = 1
+    idx = 1
+    while idx < len(argv):
+        arg = argv[idx]
+        value = None
+        if arg in ('-j', '--jobs'):
+            if idx + 1 >= len(argv):
+                raise SystemExit('{} requires an argument'.format(arg))
+            value = argv[idx + 1]
+            del argv[idx:idx + 2]
+        elif arg.startswith('-j') or arg.startswith('--jobs='):
+            value = arg[2:] if arg.startswith('-j') else arg[len('--jobs='):]
+            del argv[idx]
+        else:
+            idx += 1
+            continue
+
+        try:
+            jobs = int(value)
+        except ValueError:
+            raise SystemExit('Invalid number of jobs: {}'.format(value)) from None
+        if jobs <= 0:
+            jobs = os.cpu_count() or 1
+
+    return jobs
+
+
+def iter_test_cases(suite):
+    '''
+    Iterate over all the test cases in a (possibly nested) test suite.
+    '''
+    for test in suite:
+        if isinstance(test, unittest.TestSuite):
+            yield from iter_test_cases(test)
+        else:
+            yield test
+
+
+def init_worker(base_tmp_dir):
+    '''
+    Initialize a process used to run tests in parallel.
+
+    Each process gets its own temporary directory (inside `base_tmp_dir`, which is
+    deleted when all the tests finished), so the processes cannot interfere with each
+    other.
+    '''
+    tmp_dir = tempfile.mkdtemp(dir=base_tmp_dir)
+    tempfile.tempdir = tmp_dir
+    os.environ['TMPDIR'] = tmp_dir
+
+
+def run_test_class(args):
+    '''
+    Run the tests of a single test class in a worker process.
+
+    args:
+        A tuple containing the verbosity and the list of test IDs to run.
+    Return value:
+        A tuple containing the output of the tests, the number of tests run, the number
+        of failures, the number of errors and the number of skipped tests.
+    '''
+    verbosity, test_ids = args
+
+    suite = unittest.defaultTestLoader.loadTestsFromNames(test_ids)
+    stream = io.StringIO()
+    runner = unittest.TextTestRunner(stream=stream, verbosity=verbosity)
+    # The summary is printed once for all the classes, so we don't use `runner.run`.
+    result = runner._makeResult() # pylint: disable=protected-access
+    suite(result)
+    if not result.wasSuccessful():
+        result.printErrors()
+
+    return (stream.getvalue(),
+            result.testsRun,
+            len(result.failures) + len(result.unexpectedSuccesses),
+            len(result.errors),
+            len(result.skipped))
+
+
+def run_parallel(test_names, jobs, verbosity):
+    '''
+    Run tests using `jobs` processes.
+
+    The tests are split by class and each class runs in a single process. The output is
+    printed in the same order in which the tests would be run sequentially.
+
+    Return value:
+        True if all the specified tests passed, False oterwise.
+    '''
+    suite = unittest.defaultTestLoader.loadTestsFromNames(test_names)
+    classes = collections.OrderedDict()
+    for test in iter_test_cases(suite):
+        class_name = test.id().rsplit('.', 1)[0]
+        classes.setdefault(class_name, []).append(test.id())
+
+    base_tmp_dir = tempfile.mkdtemp()
+    start = time.monotonic()
+    tests_run = failures = errors = skipped = 0
+    try:
+        with multiprocessing.Pool(jobs, init_worker, (base_tmp_dir,)) as pool:
+            work = [(verbosity, test_ids) for test_ids in classes.values()]
+            for output, class_run, class_failures, class_errors, class_skipped in \
+                    pool.imap(run_test_class, work):
+                sys.stderr.write(output)
+                sys.stderr.flush()
+                tests_run += class_run
+                failures += class_failures
+                errors += class_errors
+                skipped += class_skipped
+    finally:
+        shutil.rmtree(base_tmp_dir, ignore_errors=True)
+    elapsed = time.monotonic() - start
+
+    sys.stderr.write('\n' + '-' * 70 + '\n')
+    sys.stderr.write('Ran {} test{} in {:.3f}s ({} jobs)\n\n'.format(
+        tests_run, '' if tests_run == 1 else 's', elapsed, jobs))
+
+    details = []
+    if failures:
+        details.append('failures={}'.format(failures))
+    if errors:
+        details.append('errors={}'.format(errors))
+    if skipped:
+        details.append('skipped={}'.format(skipped))
+    status = 'FAILED' if failures or errors else 'OK'
+    if details:
+        status += ' ({})'.format(', '.join(details))
+    sys.stderr.write(status + '\n')
+
+    return not failures and not errors
+
+
 def main(argv):
     '''
     Run tests with the specified command line options.
@@ -23,9 +171,12 @@ def main(argv):
     argv:
         The arguments to use to run tests, for instance `sys.argv`. If no tests are specified,
         then all tests are run.
+        `-j N` (or `--jobs N`) runs the tests using N processes (or one per CPU if N is 0).
     Return value:
         True if all the specified tests passed, False oterwise.
     '''
+    jobs = extract_jobs(argv)
+
     has_test_name = False
     for arg in argv[1:]:
         if not arg.startswith('-'):
@@ -45,6 +196,20 @@ def main(argv):
     # test one and add the top-level directory to the paths so karton can be imported easily.
     #os.chdir('tests')
 
+    if jobs > 1:
+        verbosity = 1
+        test_names = []
+        for arg in argv[1:]:
+            if arg in ('-v', '--verbose'):
+                verbosity = 2
+            elif arg in ('-q', '--quiet'):
+                verbosity = 0
+            elif arg.startswith('-'):
+                raise SystemExit('Option {} cannot be used with -j'.format(arg))
+            else:
+                test_names.append(arg)
+        return run_parallel(test_names, jobs, verbosity)
+
     # Let unittest run the tests as normal.
     test_program = unittest.main(module=None, exit=False, argv=argv)
     return test_program.result.wasSuccessful()
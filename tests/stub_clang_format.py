@@ -0,0 +1,270 @@
+#! /usr/bin/env python3
+#
+# Copyright (C) 2018 Undo Ltd.
+
+'''
+A small and fast replacement for clang-format used by the tests.
+
+It accepts the subset of clang-format's command line used by apply-format
+(-style, -lines, -assume-filename, -i and --version) but, instead of really
+parsing C, it just applies a few fixed rules:
+- Lines are indented by IndentWidth spaces for each level of curly braces.
+- With styles breaking before the braces of functions (like WebKit), the "{"
+  at the end of a top-level line ending with ")" is moved to its own line.
+- Trailing whitespace is removed.
+- Consecutive empty lines, and empty lines at the beginning and at the end of
+  the file, are removed.
+
+This means that the tests don't depend on which version of clang-format (if
+any) is installed.
+'''
+
+import os
+import sys
+
+
+VERSION = 'stub-clang-format version 1.0.0 (clang-format-hooks tests)'
+
+# For each supported style, the indentation width and whether the opening
+# brace of functions goes on its own line.
+STYLES = {
+    'llvm': (2, False),
+    'google': (2, False),
+    'chromium': (2, False),
+    'mozilla': (2, True),
+    'webkit': (4, True),
+    }
+
+# The values of BreakBeforeBraces which break before the braces of functions.
+FUNCTION_BREAKING_BRACES = {'Linux', 'Mozilla', 'Stroustrup', 'Allman', 'GNU', 'WebKit'}
+
+STYLE_FILE_NAMES = ('.clang-format', '_clang-format')
+
+
+class StyleError(Exception):
+    pass
+
+
+class Style():
+    '''
+    The formatting options.
+    '''
+
+    def __init__(self, name):
+        self.indent_width = None
+        self.break_functions = None
+        self.set_base_style(name)
+
+    def set_base_style(self, name):
+        try:
+            self.indent_width, self.break_functions = STYLES[name.lower()]
+        except KeyError:
+            raise StyleError('Invalid value for -style: {}'.format(name)) from None
+
+    def update(self, options, source):
+        '''
+        Update the style with the options from a configuration file.
+
+        options:
+            A list of (key, value) tuples, in the same order as in the file.
+        source:
+            The name of the configuration, used in error messages.
+        '''
+        for idx, (key, value) in enumerate(options):
+            if key == 'BasedOnStyle':
+                # The inherited options were already set.
+                if value != 'InheritParentConfig':
+                    self.set_base_style(value)
+            elif key == 'IndentWidth':
+                self.indent_width = int(value)
+            elif key == 'BreakBeforeBraces':
+                self.break_functions = value in FUNCTION_BREAKING_BRACES
+            elif key != 'Language':
+                raise StyleError("{}:{}:1: error: unknown key '{}'".format(source, idx + 1, key))
+
+
+def parse_options(text):
+    '''
+    Parse the "Key: Value" pairs in a configuration file or in an inline
+    "{Key: Value, ...}" style.
+    '''
+    text = text.strip()
+    if text.startswith('{') and text.endswith('}'):
+        entries = text[1:-1].split(',')
+    else:
+        entries = text.splitlines()
+
+    options = []
+    for entry in entries:
+        entry = entry.split('#', 1)[0].strip()
+        if not entry or entry in ('---', '...'):
+            continue
+        key, _, value = entry.partition(':')
+        options.append((key.strip(), value.strip()))
+    return options
+
+
+def find_style_file(dir_path):
+    '''
+    Find the configuration file for the files in the directory `dir_path`, like
+    clang-format's "-style=file".
+    '''
+    dir_path = os.path.abspath(dir_path)
+    while True:
+        for name in STYLE_FILE_NAMES:
+            candidate = os.path.join(dir_path, name)
+            if os.path.isfile(candidate):
+                return candidate
+        parent = os.path.dirname(dir_path)
+        if parent == dir_path:
+            return None
+        dir_path = parent
+
+
+def resolve_style(style_arg, path):
+    '''
+    Get the `Style` to use for the file `path` given the value of -style.
+    '''
+    if style_arg.startswith('{'):
+        style = Style('llvm')
+        style.update(parse_options(style_arg), 'YAML')
+    elif style_arg.lower() == 'file':
+        # A list of (options, path) tuples, starting from the configuration
+        # inherited by the other ones with "BasedOnStyle: InheritParentConfig".
+        configs = []
+        style_path = find_style_file(os.path.dirname(os.path.abspath(path)))
+        while style_path:
+            with open(style_path) as style_file:
+                options = parse_options(style_file.read())
+            configs.insert(0, (options, style_path))
+            style_dir = os.path.dirname(style_path)
+            parent_dir = os.path.dirname(style_dir)
+            if ('BasedOnStyle', 'InheritParentConfig') not in options or parent_dir == style_dir:
+                break
+            style_path = find_style_file(parent_dir)
+
+        style = Style('llvm')
+        for options, style_path in configs:
+            style.update(options, style_path)
+    else:
+        style = Style(style_arg)
+    return style
+
+
+def format_code(code, style, ranges=None):
+    '''
+    Format `code`.
+
+    ranges:
+        A list of (first, last) tuples with the 1-based line numbers to format,
+        or None to format all the lines.
+    Return value:
+        The formatted code.
+    '''
+    if not code:
+        return code
+
+    ends_with_newline = code.endswith('\n')
+    if ends_with_newline:
+        code = code[:-1]
+
+    def selected(line_number):
+        if ranges is None:
+            return True
+        return any(first <= line_number <= last for first, last in ranges)
+
+    # A list of (line, was the line selected?) tuples.
+    result = []
+    depth = 0
+    for line_number, line in enumerate(code.split('\n'), 1):
+        stripped = line.strip()
+
+        if not selected(line_number):
+            result.append((line, False))
+        elif not stripped:
+            if result and result[-1][0]:
+                result.append(('', True))
+        elif stripped.startswith('#'):
+            result.append((stripped, True))
+        else:
+            line_depth = max(depth - stripped.startswith('}'), 0)
+            indent = ' ' * (style.indent_width * line_depth)
+            if style.break_functions and not depth and stripped.endswith(') {'):
+                result.append((indent + stripped[:-2], True))
+                result.append((indent + '{', True))
+            else:
+                result.append((indent + stripped, True))
+
+        depth = max(depth + stripped.count('{') - stripped.count('}'), 0)
+
+    while result and result[-1] == ('', True):
+        result.pop()
+
+    formatted = '\n'.join(line for line, _ in result)
+    if ends_with_newline and result:
+        formatted += '\n'
+    return formatted
+
+
+def parse_lines_arg(value):
+    first, _, last = value.partition(':')
+    return int(first), int(last)
+
+
+def main(argv):
+    style_arg = 'file'
+    ranges = None
+    assume_filename = None
+    in_place = False
+    paths = []
+
+    for arg in argv[1:]:
+        name, has_value, value = arg.lstrip('-').partition('=')
+        if not arg.startswith('-'):
+            paths.append(arg)
+        elif name == 'version':
+            print(VERSION)
+            return 0
+        elif name == 'i':
+            in_place = True
+        elif name == 'style' and has_value:
+            style_arg = value
+        elif name == 'lines' and has_value:
+            ranges = (ranges or []) + [parse_lines_arg(value)]
+        elif name == 'assume-filename' and has_value:
+            assume_filename = value
+        elif name == 'fallback-style' and has_value:
+            pass
+        else:
+            sys.stderr.write('stub-clang-format: Unknown command line argument: {}\n'.format(arg))
+            return 1
+
+    if in_place and not paths:
+        sys.stderr.write('stub-clang-format: -i requires at least one file\n')
+        return 1
+
+    try:
+        if not paths:
+            code = sys.stdin.read()
+            style = resolve_style(style_arg, assume_filename or '<stdin>')
+            sys.stdout.write(format_code(code, style, ranges))
+            return 0
+
+        for path in paths:
+            with open(path) as code_file:
+                code = code_file.read()
+            formatted = format_code(code, resolve_style(style_arg, path), ranges)
+            if not in_place:
+                sys.stdout.write(formatted)
+            elif formatted != code:
+                with open(path, 'w') as code_file:
+                    code_file.write(formatted)
+    except StyleError as exc:
+        sys.stderr.write('{}\n'.format(exc))
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,106 @@
+#! /usr/bin/env python3
+#
+# Copyright (C) 2018 Undo Ltd.
+
+'''
+A replacement for clang-format-diff used by the tests.
+
+Like the real clang-format-diff, it reads a unified diff from the standard
+input and formats the changed lines, but it uses stub_clang_format instead of
+running clang-format.
+'''
+
+import argparse
+import difflib
+import re
+import sys
+
+import stub_clang_format
+
+
+def changed_lines(diff_file, strip, regex, iregex):
+    '''
+    Find the changed lines in the files in a unified diff.
+
+    Return value:
+        A list of (path, ranges) tuples, in the same order as in the diff, where
+        ranges is a list of (first, last) tuples of 1-based line numbers.
+    '''
+    files = []
+    path = None
+    for line in diff_file:
+        match = re.search(r'^\+\+\+\ (.*?/){%s}(\S*)' % strip, line)
+        if match:
+            path = match.group(2)
+            continue
+        if path is None:
+            continue
+        if regex is not None:
+            if not re.match('^%s$' % regex, path):
+                continue
+        elif not re.match('^%s$' % iregex, path, re.IGNORECASE):
+            continue
+
+        match = re.search(r'^@@.*\+(\d+)(?:,(\d+))?', line)
+        if match:
+            first = int(match.group(1))
+            count = int(match.group(2)) if match.group(2) else 1
+            if not count:
+                continue
+            if not files or files[-1][0] != path:
+                files.append((path, []))
+            files[-1][1].append((first, first + count - 1))
+
+    return files
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-i', action='store_true', default=False,
+                        help='apply edits to files instead of displaying a diff')
+    parser.add_argument('-p', metavar='NUM', default=0,
+                        help='strip the smallest prefix containing P slashes')
+    parser.add_argument('-regex', metavar='PATTERN', default=None,
+                        help='custom pattern selecting file paths to reformat (case sensitive)')
+    parser.add_argument('-iregex', metavar='PATTERN', default=r'.*\.(cpp|cc|c|h|hpp)',
+                        help='custom pattern selecting file paths to reformat (case insensitive)')
+    parser.add_argument('-style', default='file',
+                        help='formatting style to apply')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='be more verbose, ineffective without -i')
+    args = parser.parse_args(argv[1:])
+
+    status = 0
+    for path, ranges in changed_lines(sys.stdin, args.p, args.regex, args.iregex):
+        with open(path) as code_file:
+            code = code_file.read()
+        try:
+            style = stub_clang_format.resolve_style(args.style, path)
+        except stub_clang_format.StyleError as exc:
+            sys.stderr.write('{}\n'.format(exc))
+            return 2
+        formatted = stub_clang_format.format_code(code, style, ranges)
+
+        if args.i:
+            if formatted != code:
+                with open(path, 'w') as code_file:
+                    code_file.write(formatted)
+            continue
+
+        diff = difflib.unified_diff(code.splitlines(True),
+                                    formatted.splitlines(True),
+                                    path,
+                                    path,
+                                    '(before formatting)',
+                                    '(after formatting)')
+        diff_string = ''.join(diff)
+        if diff_string:
+            sys.stdout.write(diff_string)
+            # Like clang-format-diff starting with version 18.
+            status = 1
+
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
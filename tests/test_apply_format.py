@@ -1,11 +1,14 @@
 # Copyright (C) 2018 Marco Barisione
 # Copyright (C) 2018 Undo Ltd.
 
+import json
 import os
 import subprocess
+import time
 import unittest
 
 import data
+import testutils
 
 from mixin_scripts_repo import (
     ScriptsRepoMixin,
@@ -21,14 +24,6 @@ class FormatTestCaseBase():
     Test the apply-format script.
     '''
 
-    def apply_format_call(self, *args):
-        assert self.repo
-        return self.repo.check_call(os.path.join('.', self.apply_format_path), *args)
-
-    def apply_format_output(self, *args):
-        assert self.repo
-        return self.repo.check_output(os.path.join('.', self.apply_format_path), *args)
-
     def test_nothing(self):
         output = self.apply_format_output()
         self.assertEqual(output, '')
@@ -117,6 +112,12 @@ class FormatTestCaseBase():
         # The file should be fixed, so nothing left to format.
         output = self.apply_format_output()
         self.assertEqual(output, '')
+        # But the fix is not staged, so the staged content still needs formatting.
+        output = self.apply_format_output('--staged')
+        self.assertEqual(self.simplify_diff(output), data.PATCH)
+
+        # After staging the fix, there's nothing left to format.
+        self.repo.add(data.FILENAME)
         output = self.apply_format_output('--staged')
         self.assertEqual(output, '')
 
@@ -135,9 +136,65 @@ class FormatTestCaseBase():
         # The staged part should be fixed, but not the other unstaged one.
         output = self.apply_format_output()
         self.assertEqual(self.simplify_diff(output), data.MODIFIED_PART_PATCH)
+        # The fix was not staged.
+        output = self.apply_format_output('--staged')
+        self.assertEqual(self.simplify_diff(output), data.PATCH)
+
+    def test_apply_to_staged(self):
+        self.repo.write_file(data.FILENAME, data.CODE)
+        self.repo.add(data.FILENAME)
+        self.repo.write_file(data.FILENAME_ALT, data.CODE)
+        self.repo.add(data.FILENAME_ALT)
+
+        # The unstaged changes don't overlap with the fix.
+        self.repo.write_file(data.FILENAME, data.MODIFIED)
+
+        output = self.apply_format_output('--apply-to-staged')
+        self.assertEqual(output, '')
+
+        # The fix is staged and applied to the files on disk.
+        output = self.apply_format_output('--staged')
+        self.assertEqual(output, '')
+        self.assertEqual(self.repo.read_file(data.FILENAME_ALT), data.FIXED)
+        output = self.apply_format_output()
+        self.assertEqual(self.simplify_diff(output), data.MODIFIED_PART_PATCH)
+
+    def test_apply_to_staged_overlapping(self):
+        self.repo.write_file(data.FILENAME, data.CODE)
+        self.repo.add(data.FILENAME)
+
+        # The unstaged changes overlap with the fix.
+        unstaged = data.CODE.replace('return a;', 'return b;')
+        self.repo.write_file(data.FILENAME, unstaged)
+
+        output = self.apply_format_output('--apply-to-staged')
+        self.assertIn('cannot be applied to these files on disk', output)
+
+        # The fix is staged anyway, but the file on disk is not touched.
+        output = self.apply_format_output('--staged')
+        self.assertEqual(output, '')
+        self.assertEqual(self.repo.read_file(data.FILENAME), unstaged)
+        self.assertFalse(os.path.exists(self.repo.abs_path_in_repo(data.FILENAME + '.rej')))
+
+    def test_staged_ignores_files_on_disk(self):
+        # Stage the correctly formatted file, but then make it badly formatted
+        # without staging the change.
+        self.repo.write_file(data.FILENAME, data.FIXED)
+        self.repo.add(data.FILENAME)
+        self.repo.write_file(data.FILENAME, data.CODE)
+
+        # The staged content is what matters, not the one on disk.
         output = self.apply_format_output('--staged')
         self.assertEqual(output, '')
 
+        # And the other way around.
+        self.repo.write_file(data.FILENAME_ALT, data.CODE)
+        self.repo.add(data.FILENAME_ALT)
+        self.repo.write_file(data.FILENAME_ALT, data.FIXED)
+        output = self.apply_format_output('--staged')
+        self.assertEqual(self.simplify_diff(output),
+                         data.PATCH.replace(data.FILENAME, data.FILENAME_ALT))
+
     def test_two_files(self):
         # One empty file does nothing.
         self.repo.write_file(data.FILENAME, '')
@@ -159,7 +216,8 @@ class FormatTestCaseBase():
         # Two files need changes.
         self.repo.write_file(data.FILENAME_ALT, data.CODE)
         output = self.apply_format_output()
-        douple_patch = data.PATCH + data.PATCH.replace(data.FILENAME, data.FILENAME_ALT)
+        # The files are in the same order as in the output of "git diff".
+        douple_patch = data.PATCH.replace(data.FILENAME, data.FILENAME_ALT) + data.PATCH
         self.assertEqual(self.simplify_diff(output), douple_patch)
 
         # Stage the second file. Two need changes, one is staged the other isn't.
@@ -212,6 +270,538 @@ class FormatTestCaseBase():
         # "git diff -- --WHATEVER FOO" just ignores --WHATEVER.
         self.assertEqual(output, '')
 
+    def test_jobs(self):
+        filenames = ['file{}.c'.format(i) for i in range(5)]
+        for filename in filenames:
+            self.repo.write_file(filename, data.CODE)
+            self.repo.add(filename)
+
+        serial_output = self.apply_format_output('--staged')
+        self.assertEqual(self.simplify_diff(serial_output),
+                         ''.join(data.PATCH.replace(data.FILENAME, filename)
+                                 for filename in filenames))
+
+        for opt in (['--jobs', '3'], ['--jobs=2'], ['-j', '0']):
+            output = self.apply_format_output('--staged', *opt)
+            self.assertEqual(output, serial_output)
+
+        # Fix the files in place in parallel.
+        output = self.apply_format_output('--staged', '-i', '--jobs', '4')
+        self.assertEqual(output, '')
+        for filename in filenames:
+            self.assertEqual(self.repo.read_file(filename), data.FIXED)
+
+    def test_batch(self):
+        filenames = ['file{}.c'.format(i) for i in range(5)]
+        for filename in filenames:
+            self.repo.write_file(filename, data.CODE)
+            self.repo.add(filename)
+
+        serial_output = self.apply_format_output('--staged')
+
+        # The summary is printed on stderr, before the patch.
+        output = self.apply_format_output('--staged', '--batch', '--jobs', '2')
+        summary, patch = output.split('\n', 1)
+        self.assertEqual(summary,
+                         'Batched formatting: 5 added files, 2 clang-format processes, 3 saved.')
+        self.assertEqual(patch, serial_output)
+
+        # Files which were modified but not added are formatted one by one.
+        self.repo.commit(verify=False)
+        self.repo.write_file(data.FILENAME, data.CODE)
+        self.repo.add(data.FILENAME)
+        self.repo.write_file(filenames[0], data.CODE + data.CODE)
+        self.repo.add(filenames[0])
+        output = self.apply_format_output('--staged', '--batch')
+        summary, patch = output.split('\n', 1)
+        self.assertEqual(summary,
+                         'Batched formatting: 1 added files, 1 clang-format processes, 0 saved.')
+        self.assertEqual(patch, self.apply_format_output('--staged'))
+
+    def test_attributes(self):
+        self.repo.write_file(data.FILENAME, data.CODE)
+        self.repo.add(data.FILENAME)
+        self.repo.write_file(data.FILENAME_ALT, data.CODE)
+        self.repo.add(data.FILENAME_ALT)
+
+        alt_patch = data.PATCH.replace(data.FILENAME, data.FILENAME_ALT)
+
+        for attributes in ('{} clang-format=off\n', '{} -clang-format\n'):
+            self.repo.write_file('.gitattributes', attributes.format(data.FILENAME))
+            self.repo.add('.gitattributes')
+
+            for args in ([], ['--clang-format-diff'], ['--jobs', '2']):
+                output = self.apply_format_output('--staged', *args)
+                self.assertEqual(self.simplify_diff(output), alt_patch)
+
+        # Other values don't exclude the file.
+        self.repo.write_file('.gitattributes', '{} clang-format=on\n'.format(data.FILENAME))
+        self.repo.add('.gitattributes')
+        output = self.apply_format_output('--staged')
+        self.assertEqual(self.simplify_diff(output), alt_patch + data.PATCH)
+
+        # The staged attributes are used for the staged content.
+        self.repo.write_file('.gitattributes', '*.c clang-format=off\n')
+        output = self.apply_format_output('--staged')
+        self.assertEqual(self.simplify_diff(output), alt_patch + data.PATCH)
+
+    def test_limits(self):
+        self.repo.write_file(data.FILENAME, data.CODE)
+        self.repo.add(data.FILENAME)
+        self.repo.write_file(data.FILENAME_ALT, data.MODIFIED)
+        self.repo.add(data.FILENAME_ALT)
+
+        def check(args, skipped, patch):
+            output = self.apply_format_output('--staged', *args)
+            lines = output.split('\n')
+            self.assertEqual(lines[:len(skipped) + 1],
+                             ['These files were not reformatted:'] +
+                             ['    ' + line for line in skipped])
+            self.assertEqual(self.simplify_diff('\n'.join(lines[len(skipped) + 1:])), patch)
+
+        for args in ([], ['--clang-format-diff']):
+            check(['--max-file-lines', '6'] + args,
+                  ['bar.c: 11 changed lines (limit: 6)'],
+                  data.PATCH)
+
+        size = len(data.CODE) + 1
+        check(['--max-file-size={}'.format(size)],
+              ['bar.c: {} bytes (limit: {})'.format(len(data.MODIFIED), size)],
+              data.PATCH)
+
+        # Nothing is formatted if the total is over the limit.
+        output = self.apply_format_output('--staged', '--max-total-lines', '16')
+        self.assertEqual(output, '\n'.join([
+            'These files were not reformatted:',
+            '    bar.c: 17 changed lines in total (limit: 16)',
+            '    foo.c: 17 changed lines in total (limit: 16)',
+            '']))
+
+        # Generated files are never formatted.
+        self.repo.write_file('.gitattributes', '{} linguist-generated\n'.format(data.FILENAME_ALT))
+        self.repo.add('.gitattributes')
+        check([], ['bar.c: generated file (linguist-generated attribute)'], data.PATCH)
+
+        try:
+            self.apply_format_output('--max-file-size', 'big')
+            self.assertTrue(False)
+        except subprocess.CalledProcessError as exc:
+            self.assertIn('maximum size of a file', exc.output)
+
+    def make_merge(self):
+        '''
+        Start merging a branch which adds badly formatted code to data.FILENAME
+        and adds data.FILENAME_ALT, also badly formatted.
+
+        Return value:
+            The content of data.FILENAME after the merge.
+        '''
+        self.repo.write_file(data.FILENAME, data.FIXED)
+        self.repo.add(data.FILENAME)
+        self.repo.commit(verify=False)
+
+        merged = data.FIXED + '\nstatic void foo() {\nbar();\nbaz();\n}\n'
+        self.repo.git_check_call('checkout', '-q', '-b', 'merge-other')
+        self.repo.write_file(data.FILENAME, merged)
+        self.repo.add(data.FILENAME)
+        self.repo.write_file(data.FILENAME_ALT, data.CODE)
+        self.repo.add(data.FILENAME_ALT)
+        self.repo.commit(verify=False)
+        self.repo.git_check_call('checkout', '-q', '-')
+
+        self.repo.git_check_output('merge', '-q', '--no-ff', '--no-commit', 'merge-other')
+        return merged
+
+    def test_merge(self):
+        merged = self.make_merge()
+
+        # Without --merge, all the lines coming from the other branch are formatted.
+        output = self.apply_format_output('--staged')
+        self.assertIn('+  bar();', output)
+
+        # With --merge, nothing is formatted as all the lines come from one of the parents.
+        output = self.apply_format_output('--staged', '--merge')
+        self.assertEqual(output, '')
+
+        # A change made while merging is formatted.
+        self.repo.write_file(data.FILENAME, merged.replace('    return a;', '  return b;'))
+        self.repo.add(data.FILENAME)
+        output = self.apply_format_output('--staged', '--merge')
+        self.assertEqual(self.simplify_diff(output), '''\
+--- foo.c	(before formatting)
++++ foo.c	(after formatting)
+@@ ... @@
+-  return b;
++    return b;
+''')
+
+        try:
+            self.apply_format_output('--merge')
+            self.assertTrue(False)
+        except subprocess.CalledProcessError as exc:
+            self.assertIn('--merge can only be used with', exc.output)
+
+    def test_ignore_regex(self):
+        self.repo.write_file(data.FILENAME, data.CODE)
+        self.repo.add(data.FILENAME)
+        self.repo.write_file(data.FILENAME_ALT, data.CODE)
+        self.repo.add(data.FILENAME_ALT)
+
+        alt_patch = data.PATCH.replace(data.FILENAME, data.FILENAME_ALT)
+
+        for args in ([], ['--clang-format-diff']):
+            output = self.apply_format_output('--staged',
+                                              '--internal-opt-ignore-regex=nothing',
+                                              '--internal-opt-ignore-regex', r'f.o\.c|baz',
+                                              *args)
+            self.assertEqual(self.simplify_diff(output), alt_patch)
+
+    def test_trace(self):
+        self.repo.write_file(data.FILENAME, data.CODE)
+        self.repo.add(data.FILENAME)
+
+        trace_path = os.path.join(self.make_tmp_sub_dir(), 'trace.json')
+        output = self.apply_format_output('--staged',
+                                          env={'CLANG_FORMAT_HOOKS_TRACE': trace_path})
+        self.assertEqual(self.simplify_diff(output), data.PATCH)
+
+        # The array is not closed, so more events can be appended.
+        with open(trace_path) as trace_file:
+            events = json.loads(trace_file.read().rstrip().rstrip(',') + ']')
+        phases = [(event['name'], event['ph']) for event in events]
+        self.assertEqual(phases[0], ('apply-format', 'B'))
+        self.assertEqual(phases[-1], ('apply-format', 'E'))
+        self.assertIn(('git diff', 'B'), phases)
+        self.assertIn(('format ' + data.FILENAME, 'E'), phases)
+
+    def test_jobs_invalid(self):
+        try:
+            self.apply_format_output('--jobs', 'many')
+            self.assertTrue(False)
+        except subprocess.CalledProcessError as exc:
+            self.assertIn('number of jobs', exc.output)
+
+    def test_clang_format_diff(self):
+        # Unstaged changes.
+        self.repo.write_file(data.FILENAME, '')
+        self.repo.add(data.FILENAME)
+        self.repo.write_file(data.FILENAME, data.CODE)
+        # Staged changes.
+        self.repo.write_file(data.FILENAME_ALT, data.MODIFIED)
+        self.repo.add(data.FILENAME_ALT)
+
+        # The built-in code produces the same output as clang-format-diff.
+        for args in ([], ['--staged'], ['HEAD']):
+            output = self.apply_format_output(*args)
+            self.assertNotEqual(output, '')
+            output_clang_format_diff = self.apply_format_output('--clang-format-diff', *args)
+            self.assertEqual(output, output_clang_format_diff)
+
+        output = self.apply_format_output('--clang-format-diff', '-i')
+        self.assertEqual(output, '')
+        self.assertEqual(self.repo.read_file(data.FILENAME), data.FIXED)
+
+    def test_cache(self):
+        self.repo.write_file(data.FILENAME, data.CODE)
+        self.repo.add(data.FILENAME)
+
+        stats = self.cache_stats()
+        self.assertEqual(stats['Hits'], '0')
+        self.assertEqual(stats['Misses'], '0')
+
+        # The first time the file is formatted.
+        output = self.apply_format_output('--staged', '--cache')
+        self.assertEqual(self.simplify_diff(output), data.PATCH)
+        stats = self.cache_stats()
+        self.assertEqual(stats['Hits'], '0')
+        self.assertEqual(stats['Misses'], '1')
+        self.assertTrue(stats['Entries'].startswith('1 '))
+
+        # The second time the result comes from the cache.
+        cached_output = self.apply_format_output('--staged', '--cache')
+        self.assertEqual(cached_output, output)
+        stats = self.cache_stats()
+        self.assertEqual(stats['Hits'], '1')
+        self.assertEqual(stats['Misses'], '1')
+
+        # A different style means a different entry.
+        output = self.apply_format_output('--staged', '--cache', '--style', 'WebKit')
+        self.assertEqual(self.simplify_diff(output), data.PATCH_WEBKIT)
+        stats = self.cache_stats()
+        self.assertEqual(stats['Hits'], '1')
+        self.assertEqual(stats['Misses'], '2')
+
+        # Unstaged changes don't matter as the staged content is read from git.
+        self.repo.write_file(data.FILENAME, data.MODIFIED)
+        output = self.apply_format_output('--staged', '--cache')
+        self.assertEqual(output, cached_output)
+        stats = self.cache_stats()
+        self.assertEqual(stats['Hits'], '2')
+        self.assertEqual(stats['Misses'], '2')
+
+    def test_cache_style_file(self):
+        self.write_style({
+            'BasedOnStyle': 'llvm',
+            })
+        self.repo.write_file(data.FILENAME, data.CODE)
+        self.repo.add(data.FILENAME)
+
+        output = self.apply_format_output('--staged', '--cache')
+        self.assertEqual(self.simplify_diff(output), data.PATCH)
+
+        # Changing the .clang-format file invalidates the cache.
+        self.write_style({
+            'BasedOnStyle': 'WebKit',
+            })
+        output = self.apply_format_output('--staged', '--cache')
+        self.assertEqual(self.simplify_diff(output), data.PATCH_WEBKIT)
+        stats = self.cache_stats()
+        self.assertEqual(stats['Hits'], '0')
+        self.assertEqual(stats['Misses'], '2')
+
+    def test_show_style_files(self):
+        self.write_style({
+            'BasedOnStyle': 'WebKit',
+            })
+        for dir_name in ('inherit/deeper', 'llvm'):
+            testutils.makedirs(self.repo.abs_path_in_repo(dir_name))
+        self.repo.write_file('inherit/.clang-format', 'BasedOnStyle: InheritParentConfig\n')
+        self.repo.write_file('llvm/.clang-format', 'BasedOnStyle: LLVM\n')
+        filenames = ['file.c', 'inherit/deeper/file.c', 'inherit/file.c', 'llvm/file.c']
+        for filename in filenames:
+            self.repo.write_file(filename, data.CODE)
+            self.repo.add(filename)
+
+        expected_output = self.apply_format_output('--staged')
+
+        # The report is printed on stderr, before the patch.
+        # The files whose configuration inherits from another one are not
+        # batched.
+        output = self.apply_format_output('--staged', '--show-style-files', '--cache', '--batch')
+        lines = output.split('\n', 6)
+        self.assertEqual(lines[:6], [
+            'Configuration files used:',
+            '    file.c: .clang-format',
+            '    inherit/deeper/file.c: inherit/.clang-format, inheriting from .clang-format',
+            '    inherit/file.c: inherit/.clang-format, inheriting from .clang-format',
+            '    llvm/file.c: llvm/.clang-format',
+            'Batched formatting: 2 added files, 1 clang-format processes, 1 saved.',
+            ])
+        self.assertEqual(lines[6], expected_output)
+
+        output = self.apply_format_output('-f', '--show-style-files', 'llvm/file.c', 'file.c')
+        self.assertEqual(output.splitlines()[:3], [
+            'Configuration files used:',
+            '    llvm/file.c: llvm/.clang-format',
+            '    file.c: .clang-format',
+            ])
+
+        # Changing a configuration file invalidates the cache for the files
+        # using it, even through InheritParentConfig.
+        self.write_style({
+            'BasedOnStyle': 'llvm',
+            })
+        output = self.apply_format_output('--staged', '--cache')
+        stats = self.cache_stats()
+        self.assertEqual(stats['Hits'], '1')
+        self.assertEqual(stats['Misses'], '7')
+        self.assertEqual(output, self.apply_format_output('--staged'))
+
+        try:
+            self.apply_format_output('--show-style-files', '--style', 'WebKit')
+            self.assertTrue(False)
+        except subprocess.CalledProcessError as exc:
+            self.assertIn('--show-style-files can only be used', exc.output)
+
+    def test_cache_size(self):
+        self.repo.write_file(data.FILENAME, data.CODE)
+        self.repo.add(data.FILENAME)
+        self.repo.write_file(data.FILENAME_ALT, data.CODE)
+        self.repo.add(data.FILENAME_ALT)
+
+        output = self.apply_format_output('--staged', '--cache', '--cache-size', '1')
+        self.assertEqual(self.simplify_diff(output),
+                         data.PATCH.replace(data.FILENAME, data.FILENAME_ALT) + data.PATCH)
+        stats = self.cache_stats()
+        self.assertTrue(stats['Entries'].startswith('1 '))
+
+    @property
+    def tools_cache_path(self):
+        '''
+        The path of the file where the scripts cache the tools they use.
+        '''
+        return os.path.join(self.repo.env['XDG_CACHE_HOME'], 'clang-format-hooks', 'tools')
+
+    def test_tools_cache(self):
+        tools_cache_path = self.tools_cache_path
+
+        self.repo.write_file(data.FILENAME, data.CODE)
+
+        output = self.apply_format_output('-f', data.FILENAME)
+        self.assertEqual(output, data.FIXED)
+
+        with open(tools_cache_path) as tools_cache_file:
+            tools_cache = tools_cache_file.read()
+        self.assertIn('\nformat=/', tools_cache)
+
+        # Replace clang-format with a fake one in the cache, so we can see if
+        # it's used.
+        fake_path = os.path.join(self.make_tmp_sub_dir(), 'fake-clang-format')
+        with open(fake_path, 'w') as fake_file:
+            fake_file.write('#! /bin/sh\necho FAKE\n')
+        os.chmod(fake_path, 0o755)
+        # Make sure the fake script is older than the cache.
+        old_time = time.time() - 60
+        os.utime(fake_path, (old_time, old_time))
+
+        fake_tools_cache = []
+        for line in tools_cache.splitlines():
+            if line.startswith('format='):
+                line = 'format=' + fake_path
+            fake_tools_cache.append(line + '\n')
+        with open(tools_cache_path, 'w') as tools_cache_file:
+            tools_cache_file.write(''.join(fake_tools_cache))
+
+        output = self.apply_format_output('-f', data.FILENAME)
+        self.assertEqual(output, 'FAKE\n')
+
+        # Upgrading the tool means the cache is not valid anymore.
+        new_time = time.time() + 60
+        os.utime(fake_path, (new_time, new_time))
+        output = self.apply_format_output('-f', data.FILENAME)
+        self.assertEqual(output, data.FIXED)
+
+        # The cache was updated with the real tool.
+        with open(tools_cache_path) as tools_cache_file:
+            self.assertNotIn(fake_path, tools_cache_file.read())
+
+    def test_tools_cache_deleted_tool(self):
+        tools_cache_path = self.tools_cache_path
+
+        self.repo.write_file(data.FILENAME, data.CODE)
+
+        output = self.apply_format_output('-f', data.FILENAME)
+        self.assertEqual(output, data.FIXED)
+
+        # Make the cache point to a tool which doesn't exist anymore.
+        deleted_path = os.path.join(self.make_tmp_sub_dir(), 'deleted-clang-format')
+        with open(tools_cache_path) as tools_cache_file:
+            tools_cache = tools_cache_file.read()
+        stale_tools_cache = []
+        for line in tools_cache.splitlines():
+            if line.startswith('format='):
+                line = 'format=' + deleted_path
+            stale_tools_cache.append(line + '\n')
+        with open(tools_cache_path, 'w') as tools_cache_file:
+            tools_cache_file.write(''.join(stale_tools_cache))
+
+        # The tool is found again.
+        output = self.apply_format_output('-f', data.FILENAME)
+        self.assertEqual(output, data.FIXED)
+
+        with open(tools_cache_path) as tools_cache_file:
+            self.assertEqual(tools_cache_file.read(), tools_cache)
+
+    def test_tools_cache_path_dirs(self):
+        tools_cache_path = self.tools_cache_path
+
+        # A directory in $PATH which doesn't contain any tool.
+        unrelated_dir = self.make_tmp_sub_dir()
+        self.repo.env['PATH'] = unrelated_dir + os.pathsep + os.environ['PATH']
+
+        self.repo.write_file(data.FILENAME, data.CODE)
+
+        output = self.apply_format_output('-f', data.FILENAME)
+        self.assertEqual(output, data.FIXED)
+
+        # Replace clang-format with a fake one in the cache, so we can see if
+        # it's used.
+        fake_dir = self.make_tmp_sub_dir()
+        fake_path = os.path.join(fake_dir, 'fake-clang-format')
+        with open(fake_path, 'w') as fake_file:
+            fake_file.write('#! /bin/sh\necho FAKE\n')
+        os.chmod(fake_path, 0o755)
+        old_time = time.time() - 60
+        os.utime(fake_path, (old_time, old_time))
+        os.utime(fake_dir, (old_time, old_time))
+
+        with open(tools_cache_path) as tools_cache_file:
+            tools_cache = tools_cache_file.read()
+        fake_tools_cache = []
+        for line in tools_cache.splitlines():
+            if line.startswith('format='):
+                line = 'format=' + fake_path
+            fake_tools_cache.append(line + '\n')
+        with open(tools_cache_path, 'w') as tools_cache_file:
+            tools_cache_file.write(''.join(fake_tools_cache))
+
+        # Installing something unrelated in $PATH doesn't invalidate the cache.
+        new_time = time.time() + 60
+        os.utime(unrelated_dir, (new_time, new_time))
+        output = self.apply_format_output('-f', data.FILENAME)
+        self.assertEqual(output, 'FAKE\n')
+
+        # Changing the directory containing the tool does.
+        os.utime(fake_dir, (new_time, new_time))
+        output = self.apply_format_output('-f', data.FILENAME)
+        self.assertEqual(output, data.FIXED)
+
+    def test_tools_cache_symlink(self):
+        tools_cache_path = self.tools_cache_path
+
+        self.repo.write_file(data.FILENAME, data.CODE)
+
+        output = self.apply_format_output('-f', data.FILENAME)
+        self.assertEqual(output, data.FIXED)
+
+        # The cache points to a fake tool through a symbolic link, like the
+        # ones used by the Debian alternatives.
+        fake_dir = self.make_tmp_sub_dir()
+        fake_path = os.path.join(fake_dir, 'fake-clang-format')
+        with open(fake_path, 'w') as fake_file:
+            fake_file.write('#! /bin/sh\necho FAKE\n')
+        os.chmod(fake_path, 0o755)
+        link_dir = self.make_tmp_sub_dir()
+        link_path = os.path.join(link_dir, 'clang-format')
+        os.symlink(fake_path, link_path)
+        old_time = time.time() - 60
+        for path in (fake_path, fake_dir, link_dir):
+            os.utime(path, (old_time, old_time))
+
+        with open(tools_cache_path) as tools_cache_file:
+            tools_cache = tools_cache_file.read()
+        fake_tools_cache = []
+        for line in tools_cache.splitlines():
+            if line.startswith('format='):
+                line = 'format=' + link_path
+            fake_tools_cache.append(line + '\n')
+        with open(tools_cache_path, 'w') as tools_cache_file:
+            tools_cache_file.write(''.join(fake_tools_cache))
+
+        output = self.apply_format_output('-f', data.FILENAME)
+        self.assertEqual(output, 'FAKE\n')
+
+        # Changing the directory the link points to invalidates the cache.
+        new_time = time.time() + 60
+        os.utime(fake_dir, (new_time, new_time))
+        output = self.apply_format_output('-f', data.FILENAME)
+        self.assertEqual(output, data.FIXED)
+
+    def test_tools_cache_env(self):
+        self.repo.write_file(data.FILENAME, data.CODE)
+
+        output = self.apply_format_output('-f', data.FILENAME)
+        self.assertEqual(output, data.FIXED)
+
+        # Changing $CLANG_FORMAT means the cache is not used.
+        fake_path = os.path.join(self.make_tmp_sub_dir(), 'fake-clang-format')
+        with open(fake_path, 'w') as fake_file:
+            fake_file.write('#! /bin/sh\necho FAKE\n')
+        os.chmod(fake_path, 0o755)
+
+        output = self.apply_format_output('-f', data.FILENAME,
+                                          env={'CLANG_FORMAT': fake_path})
+        self.assertEqual(output, 'FAKE\n')
 
     def test_style_llvm(self):
         self.write_style({
@@ -274,12 +864,61 @@ class FormatTestCaseBase():
             output = self.apply_format_output(opt, data.FILENAME)
             self.assertEqual(output, data.FIXED)
 
+    def test_whole_file_jobs_cache(self):
+        self.repo.write_file(data.FILENAME, data.CODE)
+        self.repo.write_file(data.FILENAME_ALT, data.CODE)
+
+        output = self.apply_format_output('-f', '--jobs', '2', data.FILENAME, data.FILENAME_ALT)
+        self.assertEqual(output, data.FIXED + data.FIXED)
+
+        output = self.apply_format_output('-f', '-i', '--jobs', '2', '--cache',
+                                          data.FILENAME, data.FILENAME_ALT)
+        self.assertEqual(output, '')
+        self.assertEqual(self.repo.read_file(data.FILENAME), data.FIXED)
+        self.assertEqual(self.repo.read_file(data.FILENAME_ALT), data.FIXED)
+        stats = self.cache_stats()
+        self.assertEqual(stats['Hits'], '0')
+        self.assertEqual(stats['Misses'], '2')
+
+        # Only the modified file is reformatted.
+        self.repo.write_file(data.FILENAME_ALT, data.CODE)
+        self.apply_format_output('-f', '-i', '--jobs', '2', '--cache',
+                                 data.FILENAME, data.FILENAME_ALT)
+        self.assertEqual(self.repo.read_file(data.FILENAME_ALT), data.FIXED)
+        stats = self.cache_stats()
+        self.assertEqual(stats['Hits'], '1')
+        self.assertEqual(stats['Misses'], '3')
+
+    def test_whole_file_since(self):
+        self.repo.write_file(data.FILENAME, data.CODE)
+        self.repo.write_file(data.FILENAME_ALT, data.CODE)
+        self.repo.add(data.FILENAME)
+        self.repo.add(data.FILENAME_ALT)
+        self.repo.commit(verify=False)
+
+        output = self.apply_format_output('-f', '--since', 'HEAD')
+        self.assertEqual(output, '')
+
+        # Only the changed file is reformatted.
+        self.repo.write_file(data.FILENAME_ALT, data.CODE + '\n')
+        output = self.apply_format_output('-f', '-i', '--since', 'HEAD')
+        self.assertEqual(output, '')
+        self.assertEqual(self.repo.read_file(data.FILENAME), data.CODE)
+        self.assertEqual(self.repo.read_file(data.FILENAME_ALT), data.FIXED)
+
+        # Files specified on the command line restrict the changed ones.
+        self.repo.write_file(data.FILENAME, data.CODE + '\n')
+        self.repo.write_file(data.FILENAME_ALT, data.CODE + '\n')
+        output = self.apply_format_output('-f', '--since', 'HEAD', data.FILENAME_ALT)
+        self.assertEqual(output, data.FIXED)
+
 
 class FormatClonedTestCase(CloneRepoMixin,
                            ScriptsRepoMixin,
                            FormatTestCaseBase,
                            unittest.TestCase):
-    pass
+    # The other classes use a stub instead of clang-format.
+    REAL_CLANG_FORMAT = True
 
 
 class FormatSubmoduleTestCase(SubmoduleMixin,
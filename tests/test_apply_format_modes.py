@@ -0,0 +1,275 @@
+# Copyright (C) 2018 Marco Barisione
+# Copyright (C) 2018 Undo Ltd.
+
+import json
+import os
+import subprocess
+import time
+import unittest
+
+import data
+import testutils
+
+from mixin_scripts_repo import (
+    ScriptsWorkTreeRepoMixin,
+    CloneRepoMixin,
+    )
+
+
+class FormatModesTestCase(CloneRepoMixin,
+                          ScriptsWorkTreeRepoMixin,
+                          unittest.TestCase):
+    '''
+    Test the modes of the apply-format script which do more than reformatting a diff:
+    checking ranges of commits and pushed commits, computing the format debt, and
+    reformatting in the background.
+
+    These don't depend on how the scripts end up in the repository and some of them
+    need to wait for other processes, so they run in a single configuration (a work
+    tree, which has the most complex layout of the git directory).
+    '''
+
+    def test_check_range(self):
+        base = self.repo.git_get_head()
+
+        self.repo.write_file(data.FILENAME, data.CODE)
+        self.repo.add(data.FILENAME)
+        self.repo.commit()
+        bad_commit = self.repo.git_get_head()
+
+        self.repo.write_file(data.FILENAME, data.FIXED)
+        self.repo.add(data.FILENAME)
+        self.repo.commit()
+        good_commit = self.repo.git_get_head()
+
+        # The commits are read from git, not from disk.
+        self.repo.write_file(data.FILENAME_ALT, data.CODE)
+        self.repo.add(data.FILENAME_ALT)
+
+        report_path = os.path.join(self.make_tmp_sub_dir(), 'report.json')
+        with self.assertRaises(subprocess.CalledProcessError) as ctx:
+            self.apply_format_output('--check-range', '{}..HEAD'.format(base),
+                                     '--jobs', '2',
+                                     '--report', report_path)
+        self.assertEqual(ctx.exception.returncode, 1)
+
+        with open(report_path) as report_file:
+            report = json.load(report_file)
+        self.assertEqual(report['commits'], [
+            {
+                'commit': bad_commit,
+                'files': [{'path': data.FILENAME, 'lines': [[3, 3]]}],
+            },
+            {
+                'commit': good_commit,
+                'files': [],
+            },
+            ])
+
+        # Without problems, the report is printed on stdout.
+        output = self.apply_format_output('--check-range', '{}..HEAD'.format(bad_commit))
+        report = json.loads(output)
+        self.assertEqual(report['commits'], [{'commit': good_commit, 'files': []}])
+
+    def test_check_range_commit_config(self):
+        base = self.repo.git_get_head()
+
+        self.repo.write_file('.gitattributes', '{} clang-format=off\n'.format(data.FILENAME))
+        self.repo.add('.gitattributes')
+        self.repo.write_file(data.FILENAME, data.CODE)
+        self.repo.add(data.FILENAME)
+        self.repo.commit()
+        commit = self.repo.git_get_head()
+
+        # Each commit is checked with its own .gitattributes, not the one in the
+        # working tree.
+        os.remove(self.repo.abs_path_in_repo('.gitattributes'))
+        output = self.apply_format_output('--check-range', '{}..HEAD'.format(base))
+        report = json.loads(output)
+        self.assertEqual(report['commits'], [{'commit': commit, 'files': []}])
+
+    def test_check_range_fallback_style(self):
+        base = self.repo.git_get_head()
+
+        self.repo.write_file(data.FILENAME, data.FIXED)
+        self.repo.write_file(data.FILENAME_ALT, data.FIXED)
+        self.repo.add(data.FILENAME)
+        self.repo.add(data.FILENAME_ALT)
+        self.repo.commit()
+        commit = self.repo.git_get_head()
+
+        # Without a configuration file in the commit, the fallback style is used
+        # instead of one found in the parents of the temporary directory.
+        tmp_parent = self.make_tmp_sub_dir()
+        with open(os.path.join(tmp_parent, '.clang-format'), 'w') as style_file:
+            style_file.write('BasedOnStyle: WebKit\n')
+        tmp_dir = os.path.join(tmp_parent, 'tmp')
+        os.mkdir(tmp_dir)
+
+        for jobs in ('1', '2'):
+            output = self.apply_format_output('--check-range', '{}..HEAD'.format(base),
+                                              '--jobs', jobs,
+                                              env={'TMPDIR': tmp_dir})
+            report = json.loads(output)
+            self.assertEqual(report['commits'], [{'commit': commit, 'files': []}])
+
+    def write_server_hook(self, server_dir, name, content):
+        hook_path = os.path.join(server_dir, 'hooks', name)
+        with open(hook_path, 'w') as hook_file:
+            hook_file.write('#! /bin/sh\n' + content)
+        os.chmod(hook_path, 0o755)
+
+    def test_pre_receive(self):
+        server_dir = os.path.join(self.make_tmp_sub_dir(), 'server.git')
+        self.repo.git_check_call('init', '--quiet', '--bare', server_dir)
+        # The existing commits are pushed before installing the hook.
+        self.repo.git_check_call('push', '--quiet', server_dir, 'HEAD:refs/heads/main')
+        base = self.repo.git_get_head()
+
+        apply_format = self.repo.abs_path_in_repo(self.apply_format_path)
+        self.write_server_hook(server_dir, 'pre-receive',
+                               'exec {} --pre-receive --jobs 2\n'.format(apply_format))
+
+        self.repo.write_file(data.FILENAME, data.CODE)
+        self.repo.add(data.FILENAME)
+        self.repo.commit()
+        bad_commit = self.repo.git_check_output('rev-parse', '--short', 'HEAD').strip()
+        self.repo.write_file(data.FILENAME, data.FIXED)
+        self.repo.add(data.FILENAME)
+        self.repo.commit()
+
+        with self.assertRaises(subprocess.CalledProcessError) as ctx:
+            self.repo.git_check_output('push', server_dir, 'HEAD:refs/heads/main')
+        self.assertIn('These commits are not formatted correctly:', ctx.exception.output)
+        self.assertIn('    {} test (1 file: {})'.format(bad_commit, data.FILENAME),
+                      ctx.exception.output)
+        self.assertIn('pre-receive hook declined', ctx.exception.output)
+
+        # Each commit uses its own exclusions (and configuration).
+        # The working tree is kept, as it contains the current version of the scripts.
+        self.repo.git_check_call('reset', '--quiet', base)
+        self.repo.write_file('.clang-format-hook-exclude', data.FILENAME + '\n')
+        self.repo.add('.clang-format-hook-exclude')
+        self.repo.write_file(data.FILENAME, data.CODE)
+        self.repo.add(data.FILENAME)
+        self.repo.commit()
+        self.repo.git_check_call('push', '--quiet', server_dir, 'HEAD:refs/heads/main')
+
+        # The commits which cannot be checked in time are accepted.
+        os.remove(os.path.join(server_dir, 'hooks', 'pre-receive'))
+        slow_format = os.path.join(self.make_tmp_sub_dir(), 'slow-clang-format')
+        with open(slow_format, 'w') as slow_format_file:
+            slow_format_file.write('#! /bin/sh\n'
+                                   '[ "$1" = --version ] && exec echo "clang-format version 99"\n'
+                                   'exec sleep 60\n')
+        os.chmod(slow_format, 0o755)
+        self.write_server_hook(server_dir, 'update',
+                               'CLANG_FORMAT={} exec {} --pre-receive --time-limit 1 "$@"\n'.format(
+                                   slow_format, apply_format))
+        self.repo.write_file(data.FILENAME_ALT, data.CODE)
+        self.repo.add(data.FILENAME_ALT)
+        self.repo.commit()
+        output = self.repo.git_check_output('push', server_dir, 'HEAD:refs/heads/main')
+        unchecked_commit = self.repo.git_check_output('rev-parse', '--short', 'HEAD').strip()
+        self.assertIn('1 of 1 commits were not checked in time (limit: 1s):', output)
+        self.assertIn('    {} test'.format(unchecked_commit), output)
+        self.assertIn('These commits were accepted without checking their formatting.', output)
+
+    def test_format_debt(self):
+        testutils.makedirs(self.repo.abs_path_in_repo('sub'))
+        sub_path = os.path.join('sub', data.FILENAME_ALT)
+        self.repo.write_file(data.FILENAME, data.CODE)
+        self.repo.add(data.FILENAME)
+        self.repo.write_file(sub_path, data.CODE)
+        self.repo.add(sub_path)
+        self.repo.commit()
+
+        report = json.loads(self.apply_format_output('--format-debt', '--json'))
+        self.assertEqual(report['commit'], self.repo.git_get_head())
+        self.assertEqual(report['files'], [
+            {'path': data.FILENAME, 'lines': 1},
+            {'path': sub_path, 'lines': 1},
+            ])
+        self.assertEqual(report['directories'], [
+            {'path': '.', 'lines': 2, 'files': 2},
+            {'path': 'sub', 'lines': 1, 'files': 1},
+            ])
+
+        # The index is updated with the changed files only.
+        self.repo.write_file(data.FILENAME, data.FIXED)
+        self.repo.add(data.FILENAME)
+        self.repo.commit()
+
+        output = self.apply_format_output('--format-debt')
+        self.assertEqual(output.splitlines(), [
+            '     Lines    Files  Directory',
+            '         1        1  .',
+            '         1        1  sub',
+            ])
+
+        # Excluding a file which didn't change means it's not counted anymore.
+        self.repo.write_file('.gitattributes', '{} clang-format=off\n'.format(sub_path))
+        self.repo.add('.gitattributes')
+        self.repo.commit()
+
+        report = json.loads(self.apply_format_output('--format-debt', '--json'))
+        self.assertEqual(report['files'], [])
+
+    def test_daemon(self):
+        output = self.apply_format_output('--daemon-status')
+        self.assertEqual(output, 'The daemon is not running.\n')
+
+        output = self.apply_format_output('--daemon')
+        self.assertIn('Daemon started', output)
+        try:
+            self.repo.write_file(data.FILENAME, data.CODE)
+            self.repo.add(data.FILENAME)
+
+            # Wait for the daemon to notice the change and reformat the file.
+            for _ in range(100):
+                if not self.cache_stats()['Entries'].startswith('0 '):
+                    break
+                time.sleep(0.1)
+
+            output = self.apply_format_output('--staged', '--cache')
+            self.assertEqual(self.simplify_diff(output), data.PATCH)
+            stats = self.cache_stats()
+            self.assertEqual(stats['Hits'], '1')
+            self.assertEqual(stats['Misses'], '1')
+
+        finally:
+            output = self.apply_format_output('--daemon-stop')
+            self.assertEqual(output, 'Daemon stopped.\n')
+
+    def test_watch(self):
+        self.repo.write_file(data.FILENAME, '')
+        self.repo.add(data.FILENAME)
+
+        proc = self.repo.popen(os.path.join('.', self.apply_format_path), '--watch')
+        lines = testutils.LineReader(proc.stdout)
+        try:
+            # Once this is printed, saved files cannot be missed.
+            self.assertIsNotNone(lines.wait_for('Watching'))
+
+            self.repo.write_file(data.FILENAME, data.CODE)
+            self.assertEqual(lines.wait_for('Reformatted'),
+                             'Reformatted {}.\n'.format(data.FILENAME))
+        finally:
+            proc.terminate()
+            proc.wait()
+            lines.join()
+            proc.stdout.close()
+
+        self.assertEqual(proc.returncode, 0)
+        # Only the changed lines were formatted and nothing is left to do.
+        output = self.apply_format_output()
+        self.assertEqual(output, '')
+
+    def test_watch_invalid(self):
+        for args in (['--watch', '--staged'],
+                     ['--watch', '-i'],
+                     ['--watch', data.FILENAME],
+                     ['--watch', '-f', data.FILENAME]):
+            with self.assertRaises(subprocess.CalledProcessError) as ctx:
+                self.apply_format_output(*args)
+            self.assertIn('--watch', ctx.exception.output)
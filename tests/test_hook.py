@@ -1,16 +1,14 @@
 # Copyright (C) 2018 Marco Barisione
 # Copyright (C) 2018 Undo Ltd.
 
+import json
 import os
 import subprocess
+import time
 import unittest
 
 import data
 
-from testutils import (
-    WorkDir,
-    )
-
 from mixin_scripts_repo import (
     ScriptsRepoMixin,
     ScriptsWorkTreeRepoMixin,
@@ -20,21 +18,25 @@ from mixin_scripts_repo import (
     )
 
 
-class HookTestCaseBase():
+class HookMixin():
     '''
-    Test the git hook script.
+    Helpers to install and run the git hook script.
     '''
 
     KEY_CONFIG_INTERATIVE = 'hooks.clangFormatDiffInteractive'
     KEY_CONFIG_STYLE = 'hooks.clangFormatDiffStyle'
+    KEY_CONFIG_JOBS = 'hooks.clangFormatDiffJobs'
+    KEY_CONFIG_CACHE = 'hooks.clangFormatDiffCache'
 
-    def hook_call(self, *args):
+    def hook_call(self, *args, **kwargs):
         assert self.repo
-        return self.repo.check_call(os.path.join('.', self.pre_commit_hook_path), *args)
+        return self.repo.check_call(os.path.join('.', self.pre_commit_hook_path), *args,
+                                    **kwargs)
 
-    def hook_output(self, *args):
+    def hook_output(self, *args, **kwargs):
         assert self.repo
-        return self.repo.check_output(os.path.join('.', self.pre_commit_hook_path), *args)
+        return self.repo.check_output(os.path.join('.', self.pre_commit_hook_path), *args,
+                                      **kwargs)
 
     def config_set(self, key, value):
         assert self.repo
@@ -49,10 +51,16 @@ class HookTestCaseBase():
             return False, exc.output
 
     def write_ignore_list(self, *args):
-        with WorkDir(os.path.join(self.repo.git_dir, '..')):
-            with open('.clang-format-hook-exclude', 'w') as exclude_file:
-                exclude_file.write('\n'.join(args))
-                exclude_file.write('\n')
+        exclude_path = os.path.join(self.repo.git_dir, '..', '.clang-format-hook-exclude')
+        with open(exclude_path, 'w') as exclude_file:
+            exclude_file.write('\n'.join(args))
+            exclude_file.write('\n')
+
+
+class HookTestCaseBase(HookMixin):
+    '''
+    Test the git hook script.
+    '''
 
     def test_install(self):
         res, output = self.install()
@@ -75,6 +83,45 @@ class HookTestCaseBase():
         #self.assertEqual(output.strip(),
         #                 'There\'s already an existing pre-commit hook, but for something else.')
 
+    def test_install_stub(self):
+        path_dir = self.make_tmp_sub_dir()
+        self.repo.env['PATH'] = path_dir + os.pathsep + os.environ['PATH']
+
+        output = self.hook_output('install', '--stub')
+        self.assertEqual(output.strip(), 'Pre-commit hook generated.')
+        # The hook can be generated again, for instance to update it.
+        output = self.hook_output('install', '--stub')
+        self.assertEqual(output.strip(), 'Pre-commit hook generated.')
+
+        res, output = self.install(allow_errors=True)
+        self.assertFalse(res)
+        self.assertEqual(output.strip(), 'The hook is already installed.')
+
+        self.repo.write_file(data.FILENAME, data.CODE)
+        self.repo.add(data.FILENAME)
+        output = self.repo.commit(input_text='a\n')
+        self.assertIn('The staged content is not formatted correctly.\n', output)
+        self.assertNotIn('out of date', output)
+        self.assertEqual(self.repo.read_file(data.FILENAME), data.FIXED)
+
+        # Installing other programs doesn't affect the generated hook.
+        os.utime(path_dir, (time.time() + 60, time.time() + 60))
+        self.repo.write_file(data.FILENAME, data.CODE)
+        self.repo.add(data.FILENAME)
+        output = self.repo.commit(input_text='a\n')
+        self.assertNotIn('out of date', output)
+
+        # After changing the configuration, the hook still works, but it's slower.
+        self.config_set(self.KEY_CONFIG_STYLE, 'WebKit')
+        self.repo.write_file(data.FILENAME_ALT, data.CODE)
+        self.repo.add(data.FILENAME_ALT)
+        output = self.repo.commit(input_text='a\n')
+        self.assertIn('The generated pre-commit hook is out of date', output)
+        self.assertEqual(self.repo.read_file(data.FILENAME_ALT), data.FIXED_WEBKIT)
+
+        self.hook_output('uninstall')
+        self.assertFalse(os.path.exists(os.path.join(self.repo.git_dir, 'hooks', 'pre-commit')))
+
     def test_commit_no_errors(self):
         self.install()
 
@@ -82,6 +129,8 @@ class HookTestCaseBase():
         self.repo.add(data.FILENAME)
 
         self.repo.commit()
+        # The staged content was not touched.
+        self.assertEqual(self.repo.git_check_output('show', ':' + data.FILENAME), data.FIXED)
 
     def test_commit_fix_errors(self):
         self.install()
@@ -95,8 +144,9 @@ class HookTestCaseBase():
         # We don't check for data.PATCH as colordiff may add escapes.
         self.assertIn('before formatting', self.simplify_diff(output))
         self.assertIn('The staged content is not formatted correctly.\n', output)
-        self.assertIn('patching file {}'.format(data.FILENAME), output)
         self.assertEqual(output.count('What would you like to do?'), 1)
+        # The fix was applied to the index.
+        self.assertEqual(self.repo.git_check_output('show', ':' + data.FILENAME), data.FIXED)
 
         # The file on disk is updated.
         self.assertEqual(self.repo.read_file(data.FILENAME), data.FIXED)
@@ -106,6 +156,51 @@ class HookTestCaseBase():
         commit_diff = self.simplify_diff(self.repo.git_show())
         self.assertIn(data.FIXED_COMMIT, commit_diff)
 
+    def test_commit_nothing_to_format(self):
+        self.install()
+
+        # Without apply-format, the hook fails if it needs to format anything.
+        os.remove(self.repo.abs_path_in_repo(self.apply_format_path))
+
+        self.repo.write_file('README.txt', 'Not code.')
+        self.repo.add('README.txt')
+        output = self.repo.commit()
+        self.assertIn('The staged content is formatted correctly.\n', output)
+
+        # Files excluded through git attributes don't need formatting either.
+        # (The patterns in .clang-format-hook-exclude are matched by apply-format.)
+        self.repo.write_file('.gitattributes', '{} clang-format=off\n'.format(data.FILENAME))
+        self.repo.add('.gitattributes')
+        self.repo.write_file(data.FILENAME, data.CODE)
+        self.repo.add(data.FILENAME)
+        output = self.repo.commit()
+        self.assertIn('The staged content is formatted correctly.\n', output)
+
+        self.repo.write_file(data.FILENAME_ALT, data.CODE)
+        self.repo.add(data.FILENAME_ALT)
+        with self.assertRaises(subprocess.CalledProcessError) as ctx:
+            self.repo.commit()
+        self.assertIn('Cannot find the apply-format script', ctx.exception.output)
+
+    def test_commit_trace_excluded(self):
+        self.install()
+
+        self.write_ignore_list(data.FILENAME)
+        self.repo.write_file(data.FILENAME, data.CODE)
+        self.repo.add(data.FILENAME)
+
+        trace_path = os.path.join(self.make_tmp_sub_dir(), 'trace.json')
+        output = self.repo.commit(env={'CLANG_FORMAT_HOOKS_TRACE': trace_path})
+        self.assertIn('The staged content is formatted correctly.\n', output)
+
+        # Every phase ends, even if the hook exits early.
+        with open(trace_path) as trace_file:
+            events = json.loads(trace_file.read().rstrip().rstrip(',') + ']')
+        phases = [(event['name'], event['ph']) for event in events]
+        self.assertIn(('check exclusions', 'B'), phases)
+        self.assertEqual(sorted(name for name, ph in phases if ph == 'B'),
+                         sorted(name for name, ph in phases if ph == 'E'))
+
     def test_commit_force(self):
         self.install()
 
@@ -161,6 +256,19 @@ class HookTestCaseBase():
         # The file on disk is unchanged.
         self.assertEqual(self.repo.read_file(data.FILENAME), data.CODE)
 
+    def test_commit_non_interactive_values(self):
+        self.install()
+
+        self.repo.write_file(data.FILENAME, data.CODE)
+        self.repo.add(data.FILENAME)
+
+        # The option is parsed like git parses booleans.
+        for value in ('no', 'Off', '0'):
+            self.config_set(self.KEY_CONFIG_INTERATIVE, value)
+            with self.assertRaises(subprocess.CalledProcessError) as ctx:
+                self.repo.commit()
+            self.assertIn('--apply-to-staged', ctx.exception.output)
+
     def test_commit_no_verify(self):
         self.install()
 
@@ -191,25 +299,91 @@ class HookTestCaseBase():
         # The file on disk is updated using the specified style.
         self.assertEqual(self.repo.read_file(data.FILENAME), data.FIXED_WEBKIT)
 
+    def test_commit_jobs(self):
+        self.install()
+        self.config_set(self.KEY_CONFIG_JOBS, '4')
+
+        self.repo.write_file(data.FILENAME, data.CODE)
+        self.repo.add(data.FILENAME)
+        self.repo.write_file(data.FILENAME_ALT, data.CODE)
+        self.repo.add(data.FILENAME_ALT)
+
+        self.repo.commit(input_text='a\n')
+
+        # Both files are fixed.
+        self.assertEqual(self.repo.read_file(data.FILENAME), data.FIXED)
+        self.assertEqual(self.repo.read_file(data.FILENAME_ALT), data.FIXED)
+
+    def test_commit_limits(self):
+        self.install()
+        self.config_set('hooks.clangFormatDiffMaxFileLines', '6')
+
+        self.repo.write_file(data.FILENAME, data.CODE)
+        self.repo.add(data.FILENAME)
+        self.repo.write_file(data.FILENAME_ALT, data.MODIFIED)
+        self.repo.add(data.FILENAME_ALT)
+
+        output = self.repo.commit(input_text='a\n')
+        self.assertIn('These files were not reformatted:\n'
+                      '    bar.c: 11 changed lines (limit: 6)\n', output)
+
+        # Only the file under the limit is fixed.
+        self.assertEqual(self.repo.read_file(data.FILENAME), data.FIXED)
+        self.assertEqual(self.repo.read_file(data.FILENAME_ALT), data.MODIFIED)
+
+    def test_commit_merge(self):
+        self.repo.write_file(data.FILENAME, data.FIXED)
+        self.repo.add(data.FILENAME)
+        self.repo.commit(verify=False)
+
+        # The other branch contains badly formatted code.
+        self.repo.git_check_call('checkout', '-q', '-b', 'merge-other')
+        self.repo.write_file(data.FILENAME_ALT, data.CODE)
+        self.repo.add(data.FILENAME_ALT)
+        self.repo.commit(verify=False)
+        self.repo.git_check_call('checkout', '-q', '-')
+
+        self.install()
+        self.repo.git_check_output('merge', '-q', '--no-ff', '--no-commit', 'merge-other')
+
+        # The merge doesn't introduce any new line, so there's nothing to format.
+        output = self.repo.commit(input_text='c\n')
+        self.assertIn('The staged content is formatted correctly.', output)
+        self.assertEqual(self.repo.read_file(data.FILENAME_ALT), data.CODE)
+
+    def test_commit_cache(self):
+        self.install()
+        self.config_set(self.KEY_CONFIG_CACHE, 'true')
+
+        self.repo.write_file(data.FILENAME, data.CODE)
+        self.repo.add(data.FILENAME)
+
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.repo.commit(input_text='c\n')
+
+        # The second attempt uses the fix computed by the first one.
+        self.repo.commit(input_text='a\n')
+        self.assertEqual(self.repo.read_file(data.FILENAME), data.FIXED)
+
+        stats = self.repo.check_output(os.path.join('.', self.apply_format_path),
+                                       '--cache-stats')
+        self.assertIn('Hits: 1\n', stats)
+
     def test_install_from_scripts_dir(self):
-        with self.repo.work_dir():
-            # We go into the directory where the scripts are and intall from there.
-            # This is particularly interesting in case of submodules as we need to install a hook
-            # for the outer repository.
-            with WorkDir(self.scripts_dir):
-                subprocess.check_output(['./git-pre-commit-format', 'install'],
-                                        stderr=subprocess.STDOUT,
-                                        universal_newlines=True)
-
-            # Everything should still work.
-            self.repo.write_file(data.FILENAME, data.CODE)
-            self.repo.add(data.FILENAME)
+        # We go into the directory where the scripts are and intall from there.
+        # This is particularly interesting in case of submodules as we need to install a hook
+        # for the outer repository.
+        self.repo.check_output('./git-pre-commit-format', 'install', cwd=self.scripts_dir)
 
-            output = self.repo.commit(input_text='a\n')
-            self.assertIn('The staged content is not formatted correctly.\n', output)
+        # Everything should still work.
+        self.repo.write_file(data.FILENAME, data.CODE)
+        self.repo.add(data.FILENAME)
 
-            # The file on disk is updated.
-            self.assertEqual(self.repo.read_file(data.FILENAME), data.FIXED)
+        output = self.repo.commit(input_text='a\n')
+        self.assertIn('The staged content is not formatted correctly.\n', output)
+
+        # The file on disk is updated.
+        self.assertEqual(self.repo.read_file(data.FILENAME), data.FIXED)
 
     def test_commit_ignorefile_empty(self):
         self.install()
@@ -263,12 +437,73 @@ class HookTestCaseBase():
         # The file on disk is updated but its formatting was not fixed.
         self.assertEqual(self.repo.read_file(data.FILENAME), data.CODE)
 
+    def test_commit_ignorefile_multiple_patterns(self):
+        self.install()
+
+        self.repo.write_file(data.FILENAME, data.CODE)
+        self.repo.add(data.FILENAME)
+        self.repo.write_file(data.FILENAME_ALT, data.CODE)
+        self.repo.add(data.FILENAME_ALT)
+
+        # Ignore the first C file, but not the second one.
+        self.write_ignore_list('unrelated', r'f.o\.c|baz')
+
+        self.repo.commit(input_text='a\n')
+        self.assertEqual(self.repo.read_file(data.FILENAME), data.CODE)
+        self.assertEqual(self.repo.read_file(data.FILENAME_ALT), data.FIXED)
+
+    def test_commit_ignorefile_python_syntax(self):
+        self.install()
+
+        self.repo.write_file(data.FILENAME, data.CODE)
+        self.repo.add(data.FILENAME)
+        self.repo.write_file(data.FILENAME_ALT, data.CODE)
+        self.repo.add(data.FILENAME_ALT)
+
+        # The patterns are Python regular expressions, so lookaheads and "\w"
+        # are supported.
+        self.write_ignore_list(r'(?!bar)\w+\.C$')
+
+        self.repo.commit(input_text='a\n')
+        self.assertEqual(self.repo.read_file(data.FILENAME), data.CODE)
+        self.assertEqual(self.repo.read_file(data.FILENAME_ALT), data.FIXED)
+
+    def test_commit_ignorefile_invalid_pattern(self):
+        self.install()
+
+        self.repo.write_file(data.FILENAME, data.CODE)
+        self.repo.add(data.FILENAME)
+
+        self.write_ignore_list('foo(')
+
+        try:
+            self.repo.commit(input_text='a\n')
+            self.assertTrue(False)
+        except subprocess.CalledProcessError as exc:
+            self.assertIn('Invalid pattern for the paths to ignore "foo("', exc.output)
+
+    def test_commit_attributes(self):
+        self.install()
+
+        self.repo.write_file(data.FILENAME, data.CODE)
+        self.repo.add(data.FILENAME)
+        self.repo.write_file('.gitattributes', '{} clang-format=off\n'.format(data.FILENAME))
+        self.repo.add('.gitattributes')
+
+        # Only the excluded file needs formatting, so apply-format is not even needed.
+        os.remove(self.repo.abs_path_in_repo(self.apply_format_path))
+
+        output = self.repo.commit()
+        self.assertIn('The staged content is formatted correctly.\n', output)
+        self.assertEqual(self.repo.read_file(data.FILENAME), data.CODE)
+
 
 class HookClonedTestCase(CloneRepoMixin,
                          ScriptsRepoMixin,
                          HookTestCaseBase,
                          unittest.TestCase):
-    pass
+    # The other classes use a stub instead of clang-format.
+    REAL_CLANG_FORMAT = True
 
 
 class HookSubmoduleTestCase(SubmoduleMixin,
@@ -304,3 +539,42 @@ class HookCopiedScriptsWorkTreeTestCase(CopiedFilesMixin,
                                         HookTestCaseBase,
                                         unittest.TestCase):
     pass
+
+
+class HookDaemonTestCase(CloneRepoMixin,
+                         ScriptsWorkTreeRepoMixin,
+                         HookMixin,
+                         unittest.TestCase):
+    '''
+    Test the daemon started through the git hook script.
+
+    The daemon doesn't depend on how the scripts end up in the repository, so the
+    test runs in a single configuration.
+    '''
+
+    def test_daemon(self):
+        self.install()
+
+        # The cache is disabled by default, but the daemon needs it.
+        with self.assertRaises(subprocess.CalledProcessError) as ctx:
+            self.hook_output('start-daemon')
+        self.assertIn('The daemon needs the cache', ctx.exception.output)
+        self.config_set(self.KEY_CONFIG_CACHE, 'true')
+
+        output = self.hook_output('start-daemon')
+        self.assertIn('Daemon started', output)
+        try:
+            output = self.hook_output('daemon-status')
+            self.assertIn('The daemon is running', output)
+
+            self.repo.write_file(data.FILENAME, data.CODE)
+            self.repo.add(data.FILENAME)
+
+            # Committing works whether the daemon already reformatted the staged
+            # content or not.
+            self.repo.commit(input_text='a\n')
+            self.assertEqual(self.repo.read_file(data.FILENAME), data.FIXED)
+
+        finally:
+            output = self.hook_output('stop-daemon')
+            self.assertEqual(output, 'Daemon stopped.\n')
@@ -3,6 +3,9 @@
 
 import errno
 import os
+import queue
+import threading
+import time
 
 
 def makedirs(dir_path):
@@ -19,74 +22,67 @@ def makedirs(dir_path):
             raise
 
 
-class WorkDir():
+def make_env(overwrite_env):
     '''
-    Temporarily change the current working directory.
+    Create an environment for a subprocess.
 
-    This is supposed to be used to be used with a `with` block. Inside the
-    block, the directory is changed, but the previous one is restored when
-    the block exits.
-    '''
-
-    def __init__(self, new_work_dir):
-        '''
-        Initialize a `WorkDir`.
-
-        new_work_dir:
-        '''
-        self._old_work_dir = None
-        self._new_work_dir = new_work_dir
-
-    def __enter__(self):
-        assert self._old_work_dir is None
-        assert self._new_work_dir is not None
+    The environment of the current process is not modified, so tests can run in
+    parallel with different environments.
 
-        self._old_work_dir = os.getcwd()
-        os.chdir(self._new_work_dir)
-
-        return self
-
-    def __exit__(self, exception_type, exception_value, traceback):
-        assert self._old_work_dir is not None
-
-        os.chdir(self._old_work_dir)
-        self._old_work_dir = None
+    overwrite_env:
+        A dictionary of environment variables to overwrite, or None.
+    Return value:
+        A copy of `os.environ` with the variables in `overwrite_env` changed.
+    '''
+    env = dict(os.environ)
+    if overwrite_env:
+        env.update(overwrite_env)
+    return env
 
 
-class EnvAdder():
+class LineReader():
     '''
-    Add a directory to `$PATH`.
-
-    This is supposed to be used to be used with a `with` block.
+    Read the lines of a text stream in a background thread, so tests can wait for
+    a specific line without blocking forever.
     '''
 
-    def __init__(self, overwrite_env):
-        '''
-        Initialize an `EnvAdder`.
-
-        overwrite_env:
-            A dictionary of environment variables to overwrite.
-        '''
-        self.overwrite_env = overwrite_env
-        self._saved = None
-
-    def __enter__(self):
-        assert self._saved is None
-
-        self._saved = {}
-        for name, value in self.overwrite_env.items():
-            self._saved[name] = os.environ.get(name)
-            os.environ[name] = value
+    def __init__(self, stream):
+        self._lines = queue.Queue()
+        self._thread = threading.Thread(target=self._read, args=(stream,))
+        self._thread.daemon = True
+        self._thread.start()
 
-        return self
+    def _read(self, stream):
+        for line in stream:
+            self._lines.put(line)
+        self._lines.put(None)
 
-    def __exit__(self, exception_type, exception_value, traceback):
-        assert self._saved is not None
-
-        for name, value in self._saved.items():
-            if value is None:
-                del os.environ[name]
-            else:
-                os.environ[name] = value
+    def wait_for(self, prefix, timeout=30):
+        '''
+        Wait for a line starting with `prefix`, skipping the other ones.
+
+        prefix:
+            The start of the line to wait for.
+        timeout:
+            The maximum time to wait, in seconds.
+        Return value:
+            The line, or None if the stream ended or the timeout expired first.
+        '''
+        deadline = time.time() + timeout
+        while True:
+            try:
+                line = self._lines.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                return None
+            if line is None or line.startswith(prefix):
+                return line
+
+    def join(self, timeout=30):
+        '''
+        Wait for the stream to end, which happens when all the processes writing to
+        it exit.
 
-        self._saved = None
+        timeout:
+            The maximum time to wait, in seconds.
+        '''
+        self._thread.join(timeout)